@@ -26,21 +26,58 @@ bwa-meth supports indexes from BWA-MEM and BWA-MEM2.
 """
 from __future__ import print_function
 import tempfile
+import shutil
 import sys
 import os
 import os.path as op
 from subprocess import Popen, PIPE
 import argparse
 from subprocess import check_call
-from operator import itemgetter
-from itertools import groupby, repeat, chain, islice
+from operator import itemgetter, attrgetter
+from functools import partial
+from binascii import hexlify, unhexlify
+from itertools import groupby, repeat, chain, compress, islice
+from collections import Counter, namedtuple, deque
 import re
+import shlex
+import hashlib
+import heapq
+import json
+import struct
+import zlib
+try:
+    from StringIO import StringIO
+except ImportError: # python3
+    from io import StringIO
+try:
+    from shlex import quote as shell_quote
+except ImportError: # python2
+    from pipes import quote as shell_quote
+
+try:
+    from functools import lru_cache
+except ImportError: # python2
+    def lru_cache(maxsize=128):
+        "a cache of up to maxsize results, emptied when it is full"
+        def decorate(f):
+            cache = {}
+            def cached(*args):
+                try:
+                    return cache[args]
+                except KeyError:
+                    if len(cache) >= maxsize:
+                        cache.clear()
+                    value = cache[args] = f(*args)
+                    return value
+            return cached
+        return decorate
 
 try:
-    from itertools import izip
+    from itertools import izip, izip_longest as zip_longest
     import string
     maketrans = string.maketrans
 except ImportError: # python3
+    from itertools import zip_longest
     izip = zip
     maketrans = str.maketrans
 import toolshed
@@ -72,11 +109,14 @@ def nopen_keep_parent_stdin(f, mode="r"):
     else:
         return toolshed.files.nopen(f,mode)
 
-def checkX(cmd):
+def which(cmd):
     for p in os.environ['PATH'].split(":"):
         if os.access(os.path.join(p, cmd), os.X_OK):
-            break
-    else:
+            return os.path.join(p, cmd)
+    return None
+
+def checkX(cmd):
+    if which(cmd) is None:
         raise Exception("executable for '%s' not found" % cmd)
 
 checkX('samtools')
@@ -87,156 +127,2077 @@ class BWAMethException(Exception): pass
 def comp(s, _comp=maketrans('ATCG', 'TAGC')):
     return s.translate(_comp)
 
-def wrap(text, width=100): # much faster than textwrap
-    try: xrange
-    except NameError: xrange = range
-    for s in xrange(0, len(text), width):
-        yield text[s:s+width]
-
 def run(cmd):
     list(nopen("|%s" % cmd.lstrip("|")))
 
-def fasta_iter(fasta_name):
-    fh = nopen(fasta_name)
-    faiter = (x[1] for x in groupby(fh, lambda line: line[0] == ">"))
-    for header in faiter:
-        header = next(header)[1:].strip()
-        yield header, "".join(s.strip() for s in next(faiter)).upper()
+def nopen_bytes(f):
+    """
+    open a (possibly gzipped) file, '-' or a |process for reading bytes.
+    unlike nopen, no text decoding is done under python 3.
+    """
+    if f.startswith("|"):
+        p = Popen(f[1:], stdout=PIPE, stderr=sys.stderr, shell=True,
+                  bufsize=-1, preexec_fn=toolshed.files.prefunc,
+                  close_fds=False, executable=os.environ.get('SHELL'))
+        return p.stdout
+    if f == "-":
+        return getattr(sys.stdin, "buffer", sys.stdin)
+    f = op.expanduser(op.expandvars(f))
+    if f.endswith((".gz", ".Z", ".z")):
+        import gzip
+        return gzip.open(f, "rb")
+    if f.endswith((".bz", ".bz2", ".bzip2")):
+        import bz2
+        return bz2.BZ2File(f, "rb")
+    return open(f, "rb")
+
+BLOCK_SIZE = 256 * 1024
+
+# external decompressors in the order they are tried by
+# --decompressor auto. bgzip is only used for BGZF files.
+DECOMPRESSORS = {
+    "bgzip": ["bgzip", "-dc", "-@", "{threads}"],
+    "igzip": ["igzip", "-dc"],
+    "pigz": ["pigz", "-dc", "-p", "{threads}"],
+    "gzip": ["gzip", "-dc"],
+}
+
+def is_bgzf(path):
+    "check for the BC extra field that marks a BGZF (blocked gzip) file"
+    with open(path, "rb") as fh:
+        head = bytearray(fh.read(16))
+    return len(head) == 16 and head[:4] == b"\x1f\x8b\x08\x04" and \
+            head[12:14] == b"BC"
+
+class ProcessReader(object):
+    """
+    the stdout of a decompression process. raises an exception at the end
+    of the stream if the process failed so truncated input isn't mistaken
+    for the end of the file.
+    """
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = Popen(cmd, stdout=PIPE, stderr=sys.stderr, bufsize=-1)
+
+    def read(self, n=-1):
+        data = self.proc.stdout.read(n)
+        if not data and self.proc.wait() != 0:
+            raise BWAMethException("ERROR: '%s' failed with exit code %d\n"
+                                   % (" ".join(self.cmd), self.proc.returncode))
+        return data
+
+class ThreadedReader(object):
+    """
+    read from fh in a background thread. zlib releases the GIL, so gzipped
+    R1 and R2 files are inflated concurrently with each other and with the
+    conversion. read returns the next chunk whatever its size.
+    """
+    def __init__(self, fh, chunk_size=BLOCK_SIZE, depth=8):
+        import threading
+        try:
+            from queue import Queue
+        except ImportError: # python2
+            from Queue import Queue
+        self.queue = Queue(depth)
+        self.done = False
+        t = threading.Thread(target=self._run, args=(fh, chunk_size))
+        t.daemon = True
+        t.start()
+
+    def _run(self, fh, chunk_size):
+        try:
+            while True:
+                chunk = fh.read(chunk_size)
+                self.queue.put(chunk)
+                if not chunk: break
+        except Exception as e:
+            self.queue.put(e)
+
+    def read(self, n=-1):
+        if self.done:
+            return b""
+        chunk = self.queue.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        self.done = not chunk
+        return chunk
+
+def open_fastq(f, decompressor="auto", threads=1):
+    """
+    open a fastq for reading bytes. gzipped files are decompressed
+    according to decompressor:
+      python: the gzip module, in this process (the original behaviour)
+      thread: the gzip module, in a background thread
+      bgzip, igzip, pigz, gzip: that program, in a separate process
+      auto: bgzip for BGZF files, else igzip or pigz, whichever is found
+            first, else a thread.
+    """
+    path = op.expanduser(op.expandvars(f))
+    if not path.endswith((".gz", ".bgz")) or decompressor == "python" \
+            or not op.isfile(path):
+        return nopen_bytes(f)
+    if decompressor == "auto":
+        candidates = ["igzip", "pigz"]
+        if is_bgzf(path):
+            candidates.insert(0, "bgzip")
+        decompressor = next((c for c in candidates if which(c)), "thread")
+    if decompressor == "thread":
+        import gzip
+        return ThreadedReader(gzip.open(path, "rb"))
+    if which(decompressor) is None:
+        raise BWAMethException("executable for '%s' not found\n" % decompressor)
+    cmd = [x.format(threads=threads) for x in DECOMPRESSORS[decompressor]]
+    sys.stderr.write("decompressing %s with %s\n" % (f, decompressor))
+    return ProcessReader(cmd + [path])
+
+def byte_table(frm=b"", to=b""):
+    """
+    translation table for bytes.translate that upper-cases and then
+    replaces each byte in frm with the one in to.
+    """
+    table = bytearray(range(256))
+    table[ord('a'):ord('z') + 1] = table[ord('A'):ord('Z') + 1]
+    for a, b in zip(bytearray(frm), bytearray(to)):
+        table = bytearray(b if x == a else x for x in table)
+    return bytes(table)
+
+UPPER = byte_table()
+# indexed by read_i: read 1 is C => T, read 2 is G => A
+CONVERSIONS = ((b"CT", byte_table(b"C", b"T")),
+               (b"GA", byte_table(b"G", b"A")))
+
+def mask_table(char):
+    "table that turns a sequence into 1 where it has char and 0 elsewhere"
+    return b"".join(b"\n" if x == ord("\n") else
+                    b"1" if x == ord(char) else b"0"
+                    for x in bytearray(UPPER))
+
+# for --compact-tag: the bases that are changed by the conversion.
+MASKS = (mask_table("C"), mask_table("G"))
+
+def compact_tags(seqs, read_i):
+    """
+    the YM:Z: values for a block of newline-separated sequences: a bitmask,
+    in hex and with a leading 1 bit to keep its length, of the positions
+    that were converted. with the converted sequence, this is enough to
+    recover the original read (see `restore_converted`).
+    """
+    bits = b"1" + seqs.translate(MASKS[read_i]).replace(b"\n", b"\n1")
+    return [b"%x" % int(x, 2) for x in bits.split(b"\n")]
 
-def convert_reads(fq1s, fq2s, out=sys.stdout):
+def restore_converted(seq, mask, chars, start=0, end=0):
+    """
+    undo the conversion of chars[0] to chars[1] in seq (in read
+    orientation) at the positions set in a YM:Z: mask. the first start and
+    last end bases are left as they are; they are placeholders for
+    hard-clipped bases.
+    """
+    bits = bin(int(mask, 16))[3:]
+    if len(bits) != len(seq):
+        raise BWAMethException("YM:Z:%s doesn't match sequence length %d"
+                               % (mask, len(seq)))
+    bits = "0" * start + bits[start:len(bits) - end] + "0" * end
+    # the converted bases are flipped back by xor-ing with the difference
+    # between the characters, so the whole read is done as one integer.
+    delta = "%02x" % (ord(chars[0]) ^ ord(chars[1]))
+    seq_int = int(hexlify(seq.encode()), 16)
+    mask_int = int(bits.replace("0", "00").replace("1", delta), 16)
+    return unhexlify("%0*x" % (2 * len(seq), seq_int ^ mask_int)).decode()
+
+def translate_seqs(seqs, table, backend="python"):
+    """
+    upper-case and convert a block of newline-separated sequences. returns
+    lists of the upper-cased and converted sequences.
+    with backend="numpy", the block is viewed as a uint8 array and both
+    lookup tables are applied in a single vectorized take.
+    """
+    if backend == "numpy":
+        import numpy as np
+        luts = np.frombuffer(UPPER + table, dtype=np.uint8).reshape(2, 256)
+        upper, converted = luts.take(np.frombuffer(seqs, dtype=np.uint8),
+                                     axis=1)
+        return (upper.tobytes().split(b"\n"),
+                converted.tobytes().split(b"\n"))
+    return (seqs.translate(UPPER).split(b"\n"),
+            seqs.translate(table).split(b"\n"))
+
+class FastqBlocks(object):
+    """
+    read a fastq file in large chunks that always end on a record boundary
+    so that whole blocks can be converted without iterating over lines.
+    the bytes after the last complete record are carried over to the next
+    read.
+    """
+    def __init__(self, fh, block_size=BLOCK_SIZE):
+        self.fh = fh
+        self.block_size = block_size
+        self.rest = b""
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.fh.read(self.block_size)
+        if not chunk:
+            self.eof = True
+            if self.rest and not self.rest.endswith(b"\n"):
+                self.rest += b"\n"
+            return False
+        self.rest += chunk
+        return True
+
+    def peek_lines(self, n):
+        "return up to the first n lines without consuming them"
+        while self.rest.count(b"\n") < n and self._fill():
+            pass
+        return self.rest.split(b"\n", n)[:n]
+
+    def read(self, n=None, lines_per_unit=4):
+        """
+        return (block, n_records) for the next complete records. if n is
+        given, at most n records are returned and more data is read until
+        n records are available or the file ends. lines_per_unit=8 keeps
+        interleaved pairs together (except for a lone last record).
+        """
+        while True:
+            nlines = self.rest.count(b"\n")
+            if n is not None and nlines >= 4 * n:
+                break
+            if n is None and nlines >= lines_per_unit and \
+                    len(self.rest) >= self.block_size:
+                break
+            if not self._fill():
+                lines_per_unit = 4
+                nlines = self.rest.count(b"\n")
+                break
+        keep = nlines - nlines % lines_per_unit
+        if n is not None:
+            keep = min(keep, 4 * n)
+        pos = line_offset(self.rest, keep, nlines)
+        block, self.rest = self.rest[:pos], self.rest[pos:]
+        return block, keep // 4
+
+    def unread(self, block):
+        self.rest = block + self.rest
+
+def line_offset(data, n, total=None):
+    """
+    offset just past the n'th newline in data. searches from whichever end
+    is closer when the total number of newlines is known.
+    """
+    if n == 0:
+        return 0
+    if total is not None and total - n < n:
+        pos = len(data)
+        for _ in range(total - n + 1):
+            pos = data.rfind(b"\n", 0, pos)
+        return pos + 1
+    pos = -1
+    for _ in range(n):
+        pos = data.find(b"\n", pos + 1)
+    return pos + 1
+
+def looks_interleaved(lines):
+    "the 1st and 5th lines of a fastq are headers of reads with one name"
+    return lines[0].split(b' ')[0] == lines[-1].split(b' ')[0]
+
+def record_start(fh, offset, lines_per_unit=4, window=1 << 16):
+    """
+    offset of the first record at or after offset in an uncompressed fastq.
+    a record starts at a line that begins with '@' and is followed two
+    lines later by one that begins with '+'. with lines_per_unit=8 the
+    record after it must have the same name so that pairs are kept
+    together. returns the end of the file if there is no such record.
+    """
+    if offset == 0:
+        return 0
+    need = 4 if lines_per_unit == 8 else 2
+    while True:
+        fh.seek(offset - 1)
+        data = fh.read(window)
+        eof = len(data) < window
+        lines = data.split(b"\n")
+        if not eof:
+            lines.pop() # may be cut short
+        pos = offset + len(lines[0])
+        for j in range(1, len(lines) - need):
+            if lines[j].startswith(b"@") and lines[j + 2].startswith(b"+") \
+                    and (need == 2 or looks_interleaved(lines[j:j + 5])):
+                return pos
+            pos += len(lines[j]) + 1
+        if eof:
+            return offset - 1 + len(data)
+        window *= 2
+
+def shard_range(path, index, nshards, lines_per_unit=4):
+    """
+    (start, end) byte offsets of shard index (0-based) of nshards nearly
+    equal parts of an uncompressed fastq, moved to record boundaries.
+    """
+    size = op.getsize(path)
+    with open(path, "rb") as fh:
+        if fh.read(2) == b"\x1f\x8b":
+            raise BWAMethException("sharding by bytes needs uncompressed"
+                                   " fastqs: %s\n" % path)
+        return tuple(record_start(fh, size * i // nshards, lines_per_unit)
+                     for i in (index, index + 1))
+
+class RangeReader(object):
+    "file-like reader of the bytes from start to end of a file"
+    def __init__(self, path, start, end):
+        self.fh = open(path, "rb")
+        self.fh.seek(start)
+        self.left = end - start
+
+    def read(self, n=-1):
+        if n < 0 or n > self.left:
+            n = self.left
+        data = self.fh.read(n)
+        self.left -= len(data)
+        return data
+
+def read_blocks(fq1s, fq2s, block_size=BLOCK_SIZE, decompressor="python",
+                decompress_threads=1, byte_shard=None):
+    """
+    yield (r1_block, r2_block, interleaved) for the fastq sets where each
+    block holds complete records. for paired files both blocks hold the
+    same number of records; for single-end or interleaved input r2_block
+    is None. decompressor is passed to `open_fastq`. byte_shard is an
+    (index, nshards) tuple to read only that part of each file (see
+    `shard_range`); it is not possible with separate read 2 files.
+    """
+    def fopen(f):
+        return FastqBlocks(open_fastq(f, decompressor, decompress_threads),
+                           block_size)
 
     for fq1, fq2 in zip(fq1s.split(","), fq2s.split(",")):
         sys.stderr.write("converting reads in %s,%s\n" % (fq1, fq2))
-        fq1 = nopen(fq1)
+        path, fq1 = fq1, fopen(fq1)
 
         #examines first five lines to detect if this is an interleaved fastq file
-        first_five = list(islice(fq1, 5))
+        first_five = fq1.peek_lines(5)
+        already_interleaved = looks_interleaved(first_five)
 
-        r1_header = first_five[0]
-        r2_header = first_five[-1]
-
-        if r1_header.split(' ')[0] == r2_header.split(' ')[0]:
-            already_interleaved = True
-        else:
-            already_interleaved = False
-
-        q1_iter = izip(*[chain.from_iterable([first_five,fq1])] * 4)
+        if byte_shard is not None:
+            if fq2 != "NA":
+                raise BWAMethException("can not shard paired fastqs by"
+                                       " bytes, use records\n")
+            start, end = shard_range(path, byte_shard[0], byte_shard[1],
+                                     8 if already_interleaved else 4)
+            fq1 = FastqBlocks(RangeReader(path, start, end), block_size)
 
         if fq2 != "NA":
-            fq2 = nopen(fq2)
-            q2_iter = izip(*[fq2] * 4)
+            already_interleaved = False
+            fq2 = fopen(fq2)
         else:
             if already_interleaved:
                 sys.stderr.write("detected interleaved fastq\n")
             else:
                 sys.stderr.write("WARNING: running bwameth in single-end mode\n")
-            q2_iter = repeat((None, None, None, None))
+            fq2 = None
+
+        while True:
+            r1, n1 = fq1.read(lines_per_unit=8 if already_interleaved else 4)
+            if n1 == 0: break
+            if fq2 is None:
+                yield r1, None, already_interleaved
+                continue
+            r2, n2 = fq2.read(n1)
+            if n2 < n1:
+                # like zip, stop at the end of the shorter file.
+                cut = line_offset(r1, 4 * n2)
+                fq1.unread(r1[cut:])
+                r1 = r1[:cut]
+            if n2 == 0: break
+            yield r1, r2, False
+
+SHARD_CHUNK = 10000
+
+def deal_blocks(blocks, nshards, chunk=SHARD_CHUNK):
+    """
+    cut the (r1, r2, interleaved) blocks from `read_blocks` into runs of
+    chunk records (pairs for paired input) and deal the runs out to
+    nshards shards in turn. yields (shard, r1, r2, interleaved) with a
+    0-based shard. which shard a read goes to does not depend on the
+    block size.
+    """
+    seen = 0
+    for r1, r2, interleaved in blocks:
+        lpu = 8 if interleaved else 4
+        nlines = r1.count(b"\n")
+        n = (nlines + lpu - 1) // lpu
+        start = o1 = o2 = 0
+        while start < n:
+            run = (seen + start) // chunk
+            end = min(n, (run + 1) * chunk - seen)
+            e1 = line_offset(r1, min(end * lpu, nlines), nlines)
+            e2 = None if r2 is None else line_offset(r2, end * 4, n * 4)
+            yield (run % nshards, r1[o1:e1],
+                   None if r2 is None else r2[o2:e2], interleaved)
+            start, o1, o2 = end, e1, e2
+        seen += n
+
+def shard_blocks(blocks, index, nshards, chunk=SHARD_CHUNK):
+    "the blocks from `deal_blocks` that go to shard index"
+    for shard, r1, r2, interleaved in deal_blocks(blocks, nshards, chunk):
+        if shard == index:
+            yield r1, r2, interleaved
+
+def parse_shard(shard):
+    "(index, nshards) with a 0-based index from a shard like '1/4'"
+    try:
+        i, n = map(int, shard.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a shard like 1/4")
+    if not 1 <= i <= n:
+        raise argparse.ArgumentTypeError("shard %s is out of range" % shard)
+    return i - 1, n
+
+def block_fields(lines, start=0, step=4):
+    "name, sequence and quality lines of records from a split block"
+    return (lines[start:-1:step], lines[start + 1::step],
+            lines[start + 3::step])
+
+def convert_fields(names, seqs, quals, read_i, backend="python",
+                   compact=False):
+    """
+    convert the records given as lists of name, sequence and quality lines
+    (without newlines). returns a flat list of byte strings that join to
+    the converted records. with compact, a YM:Z: mask of the converted
+    bases is added in place of the YS:Z: copy of the original sequence.
+    """
+    n = len(seqs)
+    if n == 0:
+        return []
+    names = [x.split(b" ", 1)[0] for x in names]
+    joined = b"\n".join(names) + b"\n"
+    if joined[:1] != b"@" or joined.count(b"\n@") != n - 1:
+        bad = next(x for x in names if x[:1] != b"@")
+        raise BWAMethException("""ERROR!!!!
+    ERROR!!! FASTQ conversion failed
+    ERROR!!! expecting FASTQ 4-tuples, but found a record %s that doesn't start with "@"
+    """ % bad.decode())
+    # checking the whole block first avoids a per-read test in the common
+    # case where names have no suffixes.
+    if b"/" in joined or b"_R" in joined:
+        names = [x[:-3] if x.endswith((b"_R1", b"_R2")) else
+                 x[:-2] if x.endswith((b"/1", b"/2")) else x for x in names]
+
+    chars, table = CONVERSIONS[read_i]
+    seqs = b"\n".join(seqs)
+    upper, converted = translate_seqs(seqs, table, backend)
+    parts = [None] * (8 * n)
+    parts[0::8] = names
+    if compact:
+        parts[1::8] = repeat(b" YM:Z:", n)
+        parts[2::8] = compact_tags(seqs, read_i)
+    else:
+        # keep original sequence as name.
+        parts[1::8] = repeat(b" YS:Z:", n)
+        parts[2::8] = upper
+    parts[3::8] = repeat(b"\tYC:Z:" + chars + b"\n", n)
+    parts[4::8] = converted
+    parts[5::8] = repeat(b"\n+\n", n)
+    parts[6::8] = quals
+    parts[7::8] = repeat(b"\n", n)
+    return parts
+
+class Trimmer(object):
+    """
+    trims reads before they are converted. in order: the 3' end is quality
+    trimmed with the bwa algorithm, adapters are removed (full matches
+    anywhere in the read or partial matches of at least min_overlap bases
+    at the 3' end) and then a fixed number of bases are clipped from each
+    end. adapters, clip5 and clip3 are (read 1, read 2) pairs.
+    """
+    def __init__(self, adapters=(None, None), quality=0, clip5=(0, 0),
+                 clip3=(0, 0), min_length=20, min_overlap=3):
+        self.adapters = [a.upper().encode() if a else None for a in adapters]
+        self.quality = quality
+        self.clip5, self.clip3 = clip5, clip3
+        self.min_length = min_length
+        self.min_overlap = min_overlap
+
+    def quality_end(self, qual):
+        "length of qual after trimming low quality bases from the 3' end"
+        cutoff = self.quality + 33
+        s = max_s = 0
+        end = len(qual)
+        qual = bytearray(qual)
+        for i in range(len(qual) - 1, -1, -1):
+            s += cutoff - qual[i]
+            if s < 0: break
+            if s > max_s:
+                max_s, end = s, i
+        return end
+
+    def adapter_start(self, seq, adapter):
+        "start of the adapter in seq or len(seq) if it's not found"
+        pos = seq.find(adapter)
+        if pos != -1:
+            return pos
+        for n in range(min(len(adapter), len(seq)) - 1,
+                       self.min_overlap - 1, -1):
+            if seq.endswith(adapter[:n]):
+                return len(seq) - n
+        return len(seq)
+
+    def trim(self, seqs, quals, read_i, stats):
+        """
+        trim lists of sequences and qualities. returns the trimmed lists
+        and a list of booleans that are False for reads left shorter than
+        min_length. counts are added to stats.
+        """
+        adapter = self.adapters[read_i]
+        clip5, clip3 = self.clip5[read_i], self.clip3[read_i]
+        if adapter:
+            upper = b"\n".join(seqs).translate(UPPER).split(b"\n")
+        ends = [len(s) for s in seqs]
+        before = sum(ends)
+        if self.quality:
+            ends = [self.quality_end(q) for q in quals]
+            stats["trim_quality_bases_r%d" % (read_i + 1)] += before - sum(ends)
+        if adapter:
+            n = sum(ends)
+            starts = [self.adapter_start(u[:e], adapter)
+                      for u, e in zip(upper, ends)]
+            stats["trim_adapter_reads_r%d" % (read_i + 1)] += \
+                    sum(s < e for s, e in zip(starts, ends))
+            ends = starts
+            stats["trim_adapter_bases_r%d" % (read_i + 1)] += n - sum(ends)
+        if clip3:
+            ends = [max(e - clip3, 0) for e in ends]
+        seqs = [s[clip5:e] for s, e in zip(seqs, ends)]
+        quals = [q[clip5:e] for q, e in zip(quals, ends)]
+        stats["trim_bases_r%d" % (read_i + 1)] += \
+                before - sum(len(s) for s in seqs)
+        return seqs, quals, [len(s) >= self.min_length for s in seqs]
+
+    def report(self, stats, out=sys.stderr):
+        out.write("trimming summary:\n")
+        # stats also has the tuple keys of `profile_seqs` with --stats.
+        for k in sorted(k for k in stats if isinstance(k, str)):
+            if k.startswith(("trim_", "dropped_")):
+                out.write("  %s: %d\n" % (k, stats[k]))
+
+def trim_groups(groups, trimmer, stats):
+    """
+    trim the (names, seqs, quals) groups of a block, dropping whole pairs
+    if either read is too short after trimming so read 1 and read 2 stay
+    in sync.
+    """
+    keeps = []
+    for read_i, (names, seqs, quals) in enumerate(groups):
+        seqs, quals, keep = trimmer.trim(seqs, quals, read_i, stats)
+        groups[read_i] = (names, seqs, quals)
+        keeps.append(keep)
+    # a lone read 1 at the end of an interleaved file keeps its own status.
+    keep = [all(k) for k in izip(*keeps)] + keeps[0][len(keeps[-1]):]
+    if all(keep):
+        return groups
+    stats["dropped_%s" % ("reads" if len(groups) == 1 else "pairs")] += \
+            len(keep) - sum(keep)
+    return [tuple(list(compress(x, keep)) for x in g) for g in groups]
+
+def profile_seqs(seqs, read_i, stats):
+    """
+    add the read-length histogram, per-position base composition and base
+    totals of a list of sequences to stats. keys are tuples that start
+    with the field and read_i. columns are counted with bytes.count over a
+    transposition of the block, so there is no per-base python loop.
+    """
+    joined = b"\n".join(seqs).translate(UPPER)
+    for length, n in Counter(map(len, seqs)).items():
+        stats[("length", read_i, length)] += n
+    for base in "ACGTN":
+        stats[("total", read_i, base)] += joined.count(base.encode())
+    fill = ord("-")
+    for pos, column in enumerate(zip_longest(*bytearray(joined).split(b"\n"),
+                                             fillvalue=fill)):
+        for base in "ACGTN":
+            stats[("base", read_i, pos, base)] += column.count(ord(base))
+
+def stats_report(stats):
+    "turn the Counter from `convert_reads` into a dict for json output"
+    report = {"lt80": stats["lt80"]}
+    report.update((k, v) for k, v in stats.items() if isinstance(k, str)
+                  and k.startswith(("trim_", "dropped_")))
+    for read_i in (0, 1):
+        lengths = dict((k[2], v) for k, v in stats.items()
+                       if k[:2] == ("length", read_i))
+        if not lengths:
+            continue
+        total = dict((b, stats[("total", read_i, b)]) for b in "ACGTN")
+        npos = 1 + max(k[2] for k in stats if k[:2] == ("base", read_i))
+        composition = [dict((b, stats[("base", read_i, pos, b)])
+                            for b in "ACGTN") for pos in range(npos)]
+        # C's left in read 1 and G's in read 2 were protected by methylation
+        # (or not converted), so these hint at conversion rate.
+        report["r%d" % (read_i + 1)] = {
+            "reads": sum(lengths.values()),
+            "length_histogram": dict((str(k), v)
+                                     for k, v in sorted(lengths.items())),
+            "base_totals": total,
+            "base_composition": composition,
+            "c_to_t_ratio": total["C"] / float(total["T"] or 1),
+            "g_to_a_ratio": total["G"] / float(total["A"] or 1),
+        }
+    return report
+
+def convert_block(r1, r2=None, interleaved=False, backend="python",
+                  compact=False, trimmer=None, profile=False):
+    """
+    convert a block of complete records from `read_blocks`. returns the
+    converted, interleaved fastq and a Counter of stats, e.g. lt80, the
+    number of reads shorter than 80 bases. backend and compact are passed
+    to `convert_fields`. reads are first trimmed if a `Trimmer` is given.
+    with profile, length and base composition counts from `profile_seqs`
+    are added to the stats.
+    """
+    # drop the carriage returns of CRLF files, as reading text did.
+    if b"\r" in r1:
+        r1 = r1.replace(b"\r\n", b"\n")
+    if r2 is not None and b"\r" in r2:
+        r2 = r2.replace(b"\r\n", b"\n")
+    lines = r1.split(b"\n")
+    if r2 is not None:
+        groups = [block_fields(lines), block_fields(r2.split(b"\n"))]
+    elif interleaved:
+        groups = [block_fields(lines, 0, 8), block_fields(lines, 4, 8)]
+    else:
+        groups = [block_fields(lines)]
+
+    stats = Counter()
+    if trimmer is not None:
+        groups = trim_groups(groups, trimmer, stats)
+
+    stats["lt80"] = sum(sum(map((80).__gt__, map(len, g[1]))) for g in groups)
+    if profile:
+        for read_i, g in enumerate(groups):
+            profile_seqs(g[1], read_i, stats)
+    converted = [convert_fields(f[0], f[1], f[2], read_i, backend, compact)
+                 for read_i, f in enumerate(groups)]
+    if len(converted) == 1:
+        return b"".join(converted[0]), stats
+
+    # interleave read 1 and read 2 records. an interleaved file may end
+    # with a lone read 1 record.
+    p1, p2 = converted
+    tail = p1[len(p2):]
+    p1 = p1[:len(p2)]
+    parts = [None] * (2 * len(p2))
+    for i in range(8):
+        parts[i::16] = p1[i::8]
+        parts[8 + i::16] = p2[i::8]
+    return b"".join(parts + tail), stats
+
+def _convert_block(args, **kwargs):
+    return convert_block(*args, **kwargs)
+
+def parse_size(size):
+    "bytes in a size like 2048, 500K, 20M or 1.5G"
+    size = str(size).strip().upper().rstrip("B")
+    mult = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    if size[-1:] in mult:
+        return int(float(size[:-1]) * mult[size[-1]])
+    return int(size)
+
+# compressors for cached reads, tried in order. level 1 because the cache
+# is read back far more often than it is written.
+CACHE_COMPRESSORS = (["igzip", "-1", "-c"], ["pigz", "-1", "-c"])
+# part of the cache key. increase it when the converted reads change so
+# that entries written by an older converter are not used.
+CACHE_FORMAT = 2
+
+class ReadCache(object):
+    """
+    a directory of converted, interleaved reads keyed by a digest of the
+    input fastqs, the converter version and the options that change the
+    output. entries are gzipped and the least recently used ones are
+    removed once the directory grows beyond max_size bytes.
+    """
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        if not op.isdir(path):
+            os.makedirs(path)
+
+    def _digests(self):
+        """
+        the stored digests, less those of files that have since changed or
+        been removed so that the file does not grow with every input seen.
+        """
+        try:
+            with open(op.join(self.path, "digests.json")) as fh:
+                digests = json.load(fh)
+        except (IOError, ValueError):
+            return {}
+        return dict((s, d) for s, d in digests.items()
+                    if self.stamp(s.rsplit(":", 2)[0]) == s)
+
+    def _write_digests(self, digests):
+        tmp = op.join(self.path, "digests.json.%d" % os.getpid())
+        with open(tmp, "w") as fh:
+            json.dump(digests, fh)
+        os.rename(tmp, op.join(self.path, "digests.json"))
+
+    @staticmethod
+    def stamp(path):
+        "path, size and modification time of a file, or None if it is gone"
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return "%s:%d:%d" % (op.realpath(path), st.st_size,
+                             int(st.st_mtime * 1e9))
+
+    def file_digest(self, path, digests):
+        """
+        sha1 of a file's contents. digests of files that haven't changed
+        size or modification time since they were last seen are reused.
+        """
+        stamp = self.stamp(path)
+        if stamp not in digests:
+            h = hashlib.sha1()
+            with open(path, "rb") as fh:
+                for chunk in iter(lambda: fh.read(1 << 20), b""):
+                    h.update(chunk)
+            digests[stamp] = h.hexdigest()
+        return digests[stamp]
+
+    def key(self, fq1s, fq2s, options):
+        """
+        the cache key for these inputs, or None if any of them is not a
+        regular file (e.g. stdin) and so can't be fingerprinted.
+        """
+        paths = [f for f in fq1s.split(",") + fq2s.split(",") if f != "NA"]
+        paths = [op.expanduser(op.expandvars(f)) for f in paths]
+        if not all(op.isfile(f) for f in paths):
+            return None
+        digests = self._digests()
+        h = hashlib.sha1()
+        h.update(("bwameth %s %d %r %r\n" % (__version__, CACHE_FORMAT,
+                  sorted(options.items()),
+                  [f == "NA" for f in fq2s.split(",")])).encode())
+        for f in paths:
+            h.update(self.file_digest(f, digests).encode())
+        self._write_digests(digests)
+        return h.hexdigest()
+
+    def entry(self, key):
+        return op.join(self.path, key + ".fq.gz")
+
+    def get(self, key):
+        "the cached file for key if there is one, marking it as used"
+        path = self.entry(key)
+        if not op.exists(path):
+            return None
+        os.utime(path, None)
+        return path
+
+    def writer(self, key):
+        "a CacheWriter that stores data under key when committed"
+        return CacheWriter(self, key)
+
+    def evict(self, keep=None):
+        "remove the least recently used entries until under max_size"
+        if self.max_size is None:
+            return
+        entries = []
+        for f in os.listdir(self.path):
+            if f.endswith(".fq.gz"):
+                st = os.stat(op.join(self.path, f))
+                entries.append((st.st_mtime, st.st_size, f))
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        for _, size, f in entries:
+            if total <= self.max_size: break
+            if f == keep: continue
+            sys.stderr.write("removing %s from read cache\n" % f)
+            os.unlink(op.join(self.path, f))
+            total -= size
+
+class CacheWriter(object):
+    """
+    compresses everything written to it into a temporary file that becomes
+    a cache entry on `commit`.
+    """
+    def __init__(self, cache, key):
+        self.cache, self.key = cache, key
+        self.tmp = cache.entry(key) + ".tmp.%d" % os.getpid()
+        self.fh = open(self.tmp, "wb")
+        cmd = next((c for c in CACHE_COMPRESSORS if which(c[0])), None)
+        if cmd is None:
+            import gzip
+            self.proc = None
+            self.gz = gzip.GzipFile(fileobj=self.fh, mode="wb",
+                                    compresslevel=1)
+        else:
+            self.proc = Popen(cmd, stdin=PIPE, stdout=self.fh)
+            self.gz = self.proc.stdin
 
-        lt80 = 0
+    def write(self, data):
+        self.gz.write(data)
 
-        if already_interleaved:
-            selected_iter = q1_iter
-        else:
-            selected_iter = chain.from_iterable(izip(q1_iter, q2_iter))
+    def commit(self):
+        self.gz.close()
+        if self.proc is not None and self.proc.wait() != 0:
+            return self.abort()
+        self.fh.close()
+        os.rename(self.tmp, self.cache.entry(self.key))
+        self.cache.evict(keep=op.basename(self.cache.entry(self.key)))
 
-        for read_i, (name, seq, _, qual) in enumerate(selected_iter):
-            if name is None: continue
-            convert_and_write_read(name,seq,qual,read_i%2,out)
-            if len(seq) < 80:
-                lt80 += 1
+    def abort(self):
+        try:
+            self.gz.close()
+        finally:
+            self.fh.close()
+            if self.proc is not None:
+                self.proc.wait()
+            os.unlink(self.tmp)
+
+def bounded_map(pool, func, items, ahead):
+    """
+    func of each item, in order, from pool. at most ahead items are queued
+    so that results do not pile up when they are consumed slowly.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def convert_reads(fq1s, fq2s, out=sys.stdout, threads=1,
+                  block_size=BLOCK_SIZE, backend="python",
+                  decompressor="python", compact=False, cache_dir=None,
+                  cache_size=None, trimmer=None, stats_file=None,
+                  shard=None, shard_by="records"):
+    """
+    convert reads in fq1s (C => T) and fq2s (G => A) and write them,
+    interleaved, to out. the input is read and converted in blocks of
+    block_size bytes; with threads > 1, blocks are converted by a pool of
+    worker processes and written back in the order they were read.
+    backend is "python" or "numpy" (see `translate_seqs`) and decompressor
+    is one of those accepted by `open_fastq`. compact writes the YM:Z:
+    mask from `compact_tags` in place of the YS:Z: original sequence.
+    with cache_dir, the output is saved to (or, if already there, streamed
+    from) a `ReadCache` that is kept under cache_size bytes. reads are
+    trimmed before conversion if a `Trimmer` is given. if stats_file is
+    given, read lengths and base composition are written there as json.
+    shard is an (index, nshards) tuple from `parse_shard` to convert only
+    that share of the reads, split by "records" (`deal_blocks`) or by
+    "bytes" (`shard_range`).
+    """
+    if backend == "numpy":
+        try:
+            from importlib.util import find_spec
+        except ImportError: # python2
+            from pkgutil import find_loader as find_spec
+        if find_spec("numpy") is None:
+            sys.stderr.write("WARNING: numpy not found, using python backend\n")
+            backend = "python"
+    out = getattr(out, "buffer", out)
+    cache = None
+    if cache_dir is not None:
+        cache = ReadCache(cache_dir, cache_size)
+        key = cache.key(fq1s, fq2s, dict(compact=compact,
+                                         trim=trimmer and vars(trimmer),
+                                         shard=shard and [shard, shard_by]))
+        cached = key and cache.get(key)
+        if cached and stats_file:
+            sys.stderr.write("WARNING: not using cached reads so that"
+                             " stats can be collected\n")
+            cached = None
+        if cached:
+            sys.stderr.write("reading converted reads from cache: %s\n"
+                             % cached)
+            fh = open_fastq(cached, decompressor, threads)
+            for chunk in iter(lambda: fh.read(block_size), b""):
+                out.write(chunk)
+            out.flush()
+            return 0
+        if key is None:
+            sys.stderr.write("WARNING: not caching reads from a stream\n")
+            cache = None
+        else:
+            cache = cache.writer(key)
+
+    blocks = read_blocks(fq1s, fq2s, block_size, decompressor, threads,
+                         shard if shard_by == "bytes" else None)
+    if shard is not None and shard_by == "records":
+        blocks = shard_blocks(blocks, shard[0], shard[1])
+    convert = partial(_convert_block, backend=backend, compact=compact,
+                      trimmer=trimmer, profile=stats_file is not None)
+    stats = Counter()
+    pool = None
+    try:
+        if threads > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(threads)
+            converted = bounded_map(pool, convert, blocks, 4 * threads)
+        else:
+            converted = (convert(b) for b in blocks)
+        for text, block_stats in converted:
+            out.write(text)
+            if cache is not None:
+                cache.write(text)
+            stats.update(block_stats)
+    except BWAMethException as e:
+        sys.stderr.write(str(e))
+        if cache is not None:
+            cache.abort()
+        return 1
+    except:
+        if cache is not None:
+            cache.abort()
+        raise
+    finally:
+        if pool is not None:
+            pool.terminate()
 
     out.flush()
+    if cache is not None:
+        cache.commit()
+    if trimmer is not None:
+        trimmer.report(stats)
+    if stats_file is not None:
+        with open(stats_file, "w") as fh:
+            json.dump(stats_report(stats), fh, indent=1, sort_keys=True)
+    lt80 = stats["lt80"]
     if lt80 > 50:
         sys.stderr.write("WARNING: %i reads with length < 80\n" % lt80)
         sys.stderr.write("       : this program is designed for long reads\n")
     return 0
 
-def convert_and_write_read(name,seq,qual,read_i,out):
+# bases converted by each task of `convert_fasta_parallel` and digested
+# together by `contig_digest`. a multiple of the 100 base output lines.
+REF_SEGMENT = 16 * 10 ** 6
 
-    name = name.rstrip("\r\n").split(" ")[0]
-    if name[0] != "@":
-        sys.stderr.write("""ERROR!!!!
-    ERROR!!! FASTQ conversion failed
-    ERROR!!! expecting FASTQ 4-tuples, but found a record %s that doesn't start with "@"
-    """ % name)
-        sys.exit(1)
-    if name.endswith(("_R1", "_R2")):
-        name = name[:-3]
-    elif name.endswith(("/1", "/2")):
-        name = name[:-2]
+def contig_digest(segment_digests):
+    """
+    digest of a contig from the sha1 digests of its upper-cased sequence
+    in segments of REF_SEGMENT bases, so that segments can be digested in
+    parallel.
+    """
+    return hashlib.sha1(b"".join(segment_digests)).hexdigest()
+
+class FastaConverter(object):
+    """
+    write the G => A (r) and C => T (f) converted records of a fasta to a
+    binary file, wrapped to width, as data is passed to `write` in blocks
+    that may end within a line, so a contig on one long line is not held
+    whole. the f strand is spooled to a temporary file (kept in memory up
+    to spool_size bytes) until the r strand of the contig is written.
+    the (header, length, digest) of each contig are kept in contigs. if
+    out is None, contigs are only digested. contigs whose header is not
+    passed by keep, if given, are skipped.
+    """
+    def __init__(self, out, width=100, spool_size=1 << 26, tmp_dir=None,
+                 keep=None):
+        self.out = out
+        self.keep = keep
+        self.width = width
+        self.spool_size = spool_size
+        self.tmp_dir = tmp_dir
+        self.name = None
+        self.pending = self.head = self.ws = b""
+        self.line_start, self.in_line = True, False
+        self.spool = None
+        self.contigs = []
+
+    def write(self, data):
+        "convert data, a block of the fasta that may end within a line"
+        if self.head:
+            data, self.head = self.head + data, b""
+        pos = 0
+        while pos < len(data):
+            if self.line_start and data.startswith(b">", pos):
+                end = data.find(b"\n", pos) + 1
+                if end == 0:
+                    # only a header is carried to the next block.
+                    self.head = data[pos:]
+                    return
+                self.start(data[pos + 1:end].strip())
+                pos = end
+                continue
+            end = data.find(b"\n>", pos) + 1 or len(data)
+            if self.name is not None:
+                self.add(data[pos:end])
+            self.line_start = data[end - 1:end] == b"\n"
+            pos = end
+
+    def add(self, lines):
+        # strip whitespace from each line. lines rarely have anything
+        # but a newline (or \r\n) to strip, so avoid splitting them.
+        # whitespace at the end of a block is held in ws until it is known
+        # to be inside a line rather than at its end.
+        if self.ws or any(c in lines for c in (b" ", b"\t", b"\x0b",
+                                               b"\x0c")):
+            lines = (self.ws + lines).split(b"\n")
+            seq = []
+            for i, l in enumerate(lines):
+                if i or not self.in_line:
+                    l = l.lstrip()
+                if i < len(lines) - 1:
+                    seq.append(l.rstrip())
+                    continue
+                self.ws = l[len(l.rstrip()):]
+                seq.append(l.rstrip())
+                self.in_line = bool(seq[-1]) or (self.in_line and i == 0)
+            seq = b"".join(seq)
+        else:
+            seq = lines.translate(None, b"\r\n")
+            self.in_line = not lines.endswith(b"\n")
+        seq = self.pending + seq
+        n = len(seq) - len(seq) % self.width
+        if n:
+            self.put(seq[:n])
+        self.pending = seq[n:]
+
+    def put(self, seq):
+        self.digest(seq)
+        if self.out is None:
+            return
+        w = self.width
+        text = b"\n".join([seq[i:i + w] for i in range(0, len(seq), w)]) \
+                + b"\n"
+        self.out.write(text.translate(CONVERSIONS[1][1]))
+        self.spool.write(text.translate(CONVERSIONS[0][1]))
+
+    def digest(self, seq):
+        seq = seq.translate(UPPER)
+        self.length += len(seq)
+        while seq:
+            if self.segment is None:
+                self.segment, self.segment_left = hashlib.sha1(), REF_SEGMENT
+            part, seq = seq[:self.segment_left], seq[self.segment_left:]
+            self.segment.update(part)
+            self.segment_left -= len(part)
+            if self.segment_left == 0:
+                self.segments.append(self.segment.digest())
+                self.segment = None
+
+    def start(self, name):
+        self.finish()
+        if self.keep is not None and not self.keep(name):
+            return
+        self.name = name
+        self.ws, self.in_line = b"", False
+        self.length, self.segment, self.segments = 0, None, []
+        if self.out is None:
+            return
+        self.out.write(b">r" + name + b"\n")
+        self.spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size,
+                                                   dir=self.tmp_dir)
+
+    def finish(self):
+        "write the f strand of the current contig"
+        if self.head:
+            # a header without a newline at the end of the file.
+            head, self.head = self.head, b""
+            self.start(head[1:].strip())
+        if self.name is None:
+            return
+        if self.pending:
+            self.put(self.pending)
+            self.pending = b""
+        if self.segment is not None:
+            self.segments.append(self.segment.digest())
+        self.contigs.append((self.name.decode("latin-1"), self.length,
+                             contig_digest(self.segments)))
+        if self.out is not None:
+            self.out.write(b">f" + self.name + b"\n")
+            self.spool.seek(0)
+            for chunk in iter(lambda: self.spool.read(BLOCK_SIZE), b""):
+                self.out.write(chunk)
+            self.spool.close()
+        self.name = self.spool = None
+
+def convert_fasta_stream(fh, out, block_size=BLOCK_SIZE, tmp_dir=None,
+                         keep=None):
+    """
+    convert the binary fasta fh to out with a `FastaConverter` and return
+    the (header, length, digest) of each contig. with out=None, the
+    contigs are only digested. keep selects contigs by header.
+    """
+    conv = FastaConverter(out, tmp_dir=tmp_dir, keep=keep)
+    for chunk in iter(lambda: fh.read(block_size), b""):
+        conv.write(chunk)
+    conv.finish()
+    return conv.contigs
+
+def pwrite(fd, data, offset):
+    "write all of data to fd at offset"
+    data = memoryview(data)
+    while len(data):
+        if hasattr(os, "pwrite"):
+            n = os.pwrite(fd, data, offset)
+        else: # python2
+            os.lseek(fd, offset, os.SEEK_SET)
+            n = os.write(fd, data)
+        data, offset = data[n:], offset + n
+
+def fai_layout(ref_fasta):
+    """
+    (header, length, offset, line bases, line width) for each contig of an
+    uncompressed fasta, from its .fai, which is made with samtools faidx
+    if it is missing or older than the fasta. header is the whole header
+    line, as it is kept in the converted fasta. None if the fasta can not
+    be indexed.
+    """
+    import mmap
+    if not op.isfile(ref_fasta):
+        return None
+    with open(ref_fasta, "rb") as fh:
+        if fh.read(2) in (b"\x1f\x8b", b"BZ"):
+            return None
+    fai = ref_fasta + ".fai"
+    if not is_newer_b(ref_fasta, fai):
+        p = Popen(["samtools", "faidx", ref_fasta], stderr=PIPE)
+        p.communicate()
+        if p.returncode != 0:
+            return None
+    try:
+        rows = [l.rstrip("\r\n").split("\t") for l in open(fai)]
+    except (IOError, OSError):
+        return None
+    if not rows or op.getsize(ref_fasta) == 0:
+        return None
+    layout = []
+    with open(ref_fasta, "rb") as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for row in rows:
+                length, offset, lb, lw = map(int, row[1:5])
+                start = mm.rfind(b">", 0, offset)
+                header = mm[start + 1:offset].strip()
+                if start < 0 or b"\n" in header or \
+                        (length and lw - lb not in (1, 2)):
+                    return None
+                layout.append((header, length, offset, lb, lw))
+        finally:
+            mm.close()
+    return layout
+
+def _convert_segment(args):
+    """
+    convert nbases of the fasta, stored from start to end in lines of width
+    lw starting at column col, and write the wrapped G => A and C => T
+    lines at r_offset and f_offset of out_fa. returns the sha1 digest of
+    the upper-cased bases.
+    """
+    import mmap
+    (ref_fasta, out_fa, start, end, col, lw, nbases,
+     r_offset, f_offset) = args
+    with open(ref_fasta, "rb") as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        data = mm[start:end]
+        mm.close()
+    # every line must end where the .fai says it does.
+    ends = data[lw - 1 - col::lw]
+    seq = data.translate(None, b"\r\n")
+    if len(seq) != nbases or ends.count(b"\n") != len(ends) or \
+            data.count(b"\n") != len(ends) or \
+            any(c in seq for c in (b">", b" ", b"\t")):
+        raise BWAMethException("irregular lines in %s at byte %d\n"
+                               % (ref_fasta, start))
+    text = b"\n".join([seq[i:i + 100] for i in range(0, nbases, 100)]) + b"\n"
+    fd = os.open(out_fa, os.O_WRONLY)
+    try:
+        pwrite(fd, text.translate(CONVERSIONS[1][1]), r_offset)
+        pwrite(fd, text.translate(CONVERSIONS[0][1]), f_offset)
+    finally:
+        os.close(fd)
+    return hashlib.sha1(seq.translate(UPPER)).digest()
 
-    seq = seq.upper().rstrip('\n')
+def convert_fasta_parallel(ref_fasta, out_fa, threads=1, keep=None):
+    """
+    convert an uncompressed fasta with regular lines (as described by its
+    .fai) to out_fa. every contig has a known size once converted, so the
+    file is laid out up front and segments of REF_SEGMENT bases are read
+    from a memory map, converted with bytes.translate and written to their
+    place in the output by a pool of threads processes. returns the
+    (header, length, digest) of each contig, or None, having written
+    nothing, if the layout of the fasta can not be used. keep selects
+    contigs by header.
+    """
+    layout = fai_layout(ref_fasta)
+    if layout is None:
+        return None
+    if keep is not None:
+        layout = [c for c in layout if keep(c[0])]
+    w = 100
+    heads, jobs, nsegments, pos = [], [], [], 0
+    for header, length, offset, lb, lw in layout:
+        # bases and newlines of each strand once wrapped
+        strand = length + (length + w - 1) // w
+        r_head, f_head = b">r" + header + b"\n", b">f" + header + b"\n"
+        r_start = pos + len(r_head)
+        f_start = r_start + strand + len(f_head)
+        heads += [(pos, r_head), (r_start + strand, f_head)]
+        for a in range(0, length, REF_SEGMENT):
+            b = min(length, a + REF_SEGMENT)
+            jobs.append((ref_fasta, out_fa,
+                         offset + (a // lb) * lw + a % lb,
+                         offset + ((b - 1) // lb) * lw + (b - 1) % lb + 1,
+                         a % lb, lw, b - a,
+                         r_start + a + a // w, f_start + a + a // w))
+        nsegments.append((length + REF_SEGMENT - 1) // REF_SEGMENT)
+        pos = f_start + strand
+
+    with open(out_fa, "wb") as fh:
+        fh.truncate(pos)
+    fd = os.open(out_fa, os.O_WRONLY)
+    try:
+        for offset, head in heads:
+            pwrite(fd, head, offset)
+    finally:
+        os.close(fd)
 
+    pool = None
+    try:
+        if threads > 1 and len(jobs) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(threads, len(jobs)))
+            digests = pool.map(_convert_segment, jobs)
+        else:
+            digests = [_convert_segment(job) for job in jobs]
+    except BWAMethException as e:
+        sys.stderr.write(str(e))
+        os.unlink(out_fa)
+        return None
+    finally:
+        if pool is not None:
+            pool.terminate()
+    contigs, i = [], 0
+    for (header, length, _, _, _), n in zip(layout, nsegments):
+        contigs.append((header.decode("latin-1"), length,
+                        contig_digest(digests[i:i + n])))
+        i += n
+    return contigs
+
+def fasta_contigs(ref_fasta, keep=None):
+    "(header, length, digest) of each contig, as recorded in the manifest"
+    return convert_fasta_stream(nopen_bytes(ref_fasta), None, keep=keep)
+
+class ContigFilter(object):
+    """
+    choose the contigs of a reference to convert by name, with include
+    and exclude regular expressions or a file of names (the first word of
+    each line, so a .fai works), and by min_length. `keep` takes a fasta
+    header. `prepare` must be called with the fasta to filter by length.
+    """
+    def __init__(self, include=None, exclude=None, names_file=None,
+                 min_length=0):
+        self.include = include and re.compile(include)
+        self.exclude = exclude and re.compile(exclude)
+        self.names = None
+        if names_file:
+            with open(names_file) as fh:
+                self.names = set(l.split()[0] for l in fh if l.strip())
+        self.min_length = min_length
+        self.lengths = {}
+        self.skipped = []
+        # stored in the manifest: a different filter means converting again
+        self.record = {"include": include, "exclude": exclude,
+                       "min_length": min_length, "names": self.names and
+                       hashlib.sha1("\n".join(sorted(self.names)).encode()
+                                    ).hexdigest()}
+
+    def prepare(self, ref_fasta):
+        if not self.min_length:
+            return
+        layout = fai_layout(ref_fasta)
+        if layout is not None:
+            contigs = [(h, n) for h, n, _, _, _ in layout]
+        else:
+            contigs = [(h.encode("latin-1"), n)
+                       for h, n, _ in fasta_contigs(ref_fasta)]
+        self.lengths = dict((h.split()[0], n) for h, n in contigs)
+
+    def keep(self, header):
+        name = (header.split() or [b""])[0]
+        keep = (self.names is None or name.decode() in self.names) and \
+            (not self.include or self.include.search(name.decode())) and \
+            not (self.exclude and self.exclude.search(name.decode())) and \
+            self.lengths.get(name, self.min_length) >= self.min_length
+        if not keep:
+            self.skipped.append(name.decode())
+        return bool(keep)
+
+def write_alt(ref_fasta, out_fa, contigs):
+    """
+    write out_fa.alt with the converted names of the contigs that are
+    listed in ref_fasta.alt (the first column of the sam lines in bwakit's
+    .alt files) so that bwa mem handles alt contigs as it would for
+    ref_fasta. bwa only uses the names from the file.
+    """
+    alt = out_fa + ".alt"
+    names = set()
+    if op.exists(ref_fasta + ".alt"):
+        with open(ref_fasta + ".alt") as fh:
+            names = set(l.split("\t")[0].strip() for l in fh
+                        if l.strip() and not l.startswith("@"))
+    kept = [c[0].split()[0] for c in contigs if c[0].split()[0] in names]
+    text = "".join("%s%s\n" % (s, n) for n in kept for s in "rf")
+    if not kept and op.exists(alt):
+        os.unlink(alt)
+    if not kept or op.exists(alt) and open(alt).read() == text:
+        return
+    sys.stderr.write("marking %d alt contigs in %s\n" % (len(kept), alt))
+    with open(alt, "w") as fh:
+        fh.write(text)
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_stat(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime": st.st_mtime}
+
+def manifest_path(conv_fa):
+    return conv_fa + ".manifest.json"
+
+def read_manifest(conv_fa):
+    """
+    the manifest kept next to a converted fasta by `convert_fasta` and
+    `bwa_index`, or None if there is none or it can't be used.
+    """
+    try:
+        with open(manifest_path(conv_fa)) as fh:
+            manifest = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+    if manifest.get("segment") != REF_SEGMENT:
+        return None
+    return manifest
+
+def write_manifest(conv_fa, manifest):
+    path = manifest_path(conv_fa)
+    try:
+        with open(path + ".tmp", "w") as fh:
+            json.dump(manifest, fh, indent=1, sort_keys=True)
+        os.rename(path + ".tmp", path)
+    except (IOError, OSError) as e:
+        sys.stderr.write("WARNING: could not write %s: %s\n" % (path, e))
 
-    char_a, char_b = ['CT', 'GA'][read_i]
-    # keep original sequence as name.
-    name = " ".join((name,
-                     "YS:Z:" + seq +
-                     "\tYC:Z:" + char_a + char_b + '\n'))
-    seq = seq.replace(char_a, char_b)
-    out.write("".join((name, seq, "\n+\n", qual)))
+def new_manifest(ref_fasta, contigs, conv_fa, sha1=None):
+    """
+    the manifest of a converted fasta: the digest of each contig of the
+    source, the sha1 of the converted fasta (computed unless given) and,
+    once made, the bwa indexes of it. sizes and mtimes let a check skip
+    the digests when the files have not been touched.
+    """
+    source = file_stat(ref_fasta)
+    source["path"] = op.abspath(ref_fasta)
+    source["contigs"] = [list(c) for c in contigs]
+    converted = file_stat(conv_fa)
+    converted["sha1"] = sha1 or file_sha1(conv_fa)
+    return {"bwameth": __version__, "segment": REF_SEGMENT,
+            "source": source, "converted": converted, "indexes": {}}
+
+def source_contigs(ref_fasta, source, keep=None):
+    """
+    the contigs of ref_fasta, as in the manifest. those recorded in source
+    are used unless the size or mtime differ, e.g. after a copy. source
+    takes the new size and mtime if the contigs match.
+    """
+    stat = file_stat(ref_fasta)
+    if all(source.get(k) == v for k, v in stat.items()):
+        return source["contigs"]
+    sys.stderr.write("checking contigs of %s\n" % ref_fasta)
+    contigs = [list(c) for c in fasta_contigs(ref_fasta, keep)]
+    if contigs == source["contigs"]:
+        source.update(stat)
+    return contigs
+
+def contig_spans(contigs):
+    """
+    (offset, size) in the converted fasta of the r and f records of each
+    of the (header, length, digest) contigs, in order.
+    """
+    spans, pos = [], 0
+    for header, length, _ in contigs:
+        lines = length + (length + 99) // 100
+        size = 2 * (len(header.encode("latin-1")) + 3 + lines)
+        spans.append((pos, size))
+        pos += size
+    return spans
+
+def splice_fasta(ref_fasta, out_fa, old_contigs, contigs, threads=1):
+    """
+    update out_fa, the conversion of old_contigs, to hold the (header,
+    length, digest) contigs now in ref_fasta. contigs that were already
+    converted are copied from out_fa and only the rest are converted.
+    returns the sha1 of the new out_fa and the number of contigs that
+    were converted.
+    """
+    old = dict((tuple(c), s) for c, s in zip(old_contigs,
+                                              contig_spans(old_contigs)))
+    changed = [c for c in contigs if tuple(c) not in old]
+    headers = set(c[0].encode("latin-1") for c in changed)
+    keep = lambda header: header in headers
+    tmp, new_tmp = out_fa + ".changed", out_fa + ".tmp"
+    try:
+        converted = convert_fasta_parallel(ref_fasta, tmp, threads, keep)
+        if converted is None:
+            with open(tmp, "wb") as fh:
+                converted = convert_fasta_stream(nopen_bytes(ref_fasta), fh,
+                                     tmp_dir=op.dirname(op.abspath(out_fa)),
+                                     keep=keep)
+        if [list(c) for c in converted] != [list(c) for c in changed]:
+            raise BWAMethException("%s changed while converting\n"
+                                   % ref_fasta)
+        new = dict((tuple(c), s) for c, s in zip(changed,
+                                                  contig_spans(changed)))
+        h = hashlib.sha1()
+        with open(new_tmp, "wb") as out, open(out_fa, "rb") as old_fh, \
+                open(tmp, "rb") as new_fh:
+            for c in contigs:
+                fh, (start, size) = (old_fh, old[tuple(c)]) \
+                        if tuple(c) in old else (new_fh, new[tuple(c)])
+                fh.seek(start)
+                while size:
+                    chunk = fh.read(min(size, 1 << 20))
+                    if not chunk:
+                        raise BWAMethException("%s is truncated\n" % out_fa)
+                    out.write(chunk)
+                    h.update(chunk)
+                    size -= len(chunk)
+        os.rename(new_tmp, out_fa)
+    finally:
+        for f in (tmp, new_tmp):
+            if op.exists(f):
+                os.unlink(f)
+    return h.hexdigest(), len(changed)
+
+def converted_unchanged(conv_fa, converted):
+    "like `source_contigs` but checks the sha1 of the converted fasta"
+    if not op.exists(conv_fa):
+        return False
+    stat = file_stat(conv_fa)
+    if all(converted.get(k) == v for k, v in stat.items()):
+        return True
+    sys.stderr.write("checking %s\n" % conv_fa)
+    if file_sha1(conv_fa) != converted["sha1"]:
+        return False
+    converted.update(stat)
+    return True
+
+def update_fasta(ref_fasta, out_fa, manifest, contigs, threads=1,
+                 record=None):
+    """
+    re-convert only the contigs of ref_fasta that differ from those in the
+    manifest of out_fa with `splice_fasta`, and say whether the indexes
+    need to be built again.
+    """
+    old = manifest["source"]["contigs"]
+    sys.stderr.write("updating %s from %s\n" % (out_fa, ref_fasta))
+    sha1, nchanged = splice_fasta(ref_fasta, out_fa, old, contigs, threads)
+    names = lambda cs: set(c[0].split()[0] for c in cs)
+    sys.stderr.write("converted %d changed or new contigs, reused %d and"
+                     " removed %d\n" % (nchanged, len(contigs) - nchanged,
+                     len(names(old) - names(contigs))))
+    new = new_manifest(ref_fasta, contigs, out_fa, sha1)
+    new["filter"] = record
+    if sha1 == manifest["converted"]["sha1"]:
+        sys.stderr.write("the converted fasta is the same, so the indexes"
+                         " are kept\n")
+        new["indexes"] = manifest["indexes"]
+    elif manifest["indexes"]:
+        aligners = dict((v, k) for k, v in ALIGNERS.items())
+        sys.stderr.write("the converted fasta changed, so the %s index must"
+                         " be rebuilt in full\n" % " and ".join(
+                         aligners[v] for v in sorted(manifest["indexes"])))
+    write_manifest(out_fa, new)
+    write_alt(ref_fasta, out_fa, contigs)
+    return out_fa
 
-def convert_fasta(ref_fasta, just_name=False):
+def convert_fasta(ref_fasta, just_name=False, threads=1, contig_filter=None):
+    """
+    convert ref_fasta, or the contigs of it that pass a `ContigFilter`,
+    unless the manifest shows that this was already done.
+    """
     out_fa = ref_fasta + ".bwameth.c2t"
     if just_name:
         return out_fa
     msg = "c2t in %s to %s" % (ref_fasta, out_fa)
-    if is_newer_b(ref_fasta, out_fa):
+    keep, record = None, None
+    if contig_filter is not None:
+        contig_filter.prepare(ref_fasta)
+        keep, record = contig_filter.keep, contig_filter.record
+    manifest = read_manifest(out_fa)
+    if manifest is not None:
+        if manifest.get("filter") == record and \
+                converted_unchanged(out_fa, manifest["converted"]):
+            old = manifest["source"]["contigs"]
+            contigs = source_contigs(ref_fasta, manifest["source"], keep)
+            if contigs == old:
+                write_manifest(out_fa, manifest)
+                write_alt(ref_fasta, out_fa, contigs)
+                sys.stderr.write("already converted: %s\n" % msg)
+                return out_fa
+            if set(map(tuple, old)) & set(map(tuple, contigs)):
+                return update_fasta(ref_fasta, out_fa, manifest, contigs,
+                                    threads, record)
+    elif record is None and is_newer_b(ref_fasta, out_fa):
+        # converted before there were manifests. record it as it is.
         sys.stderr.write("already converted: %s\n" % msg)
+        write_manifest(out_fa, new_manifest(ref_fasta,
+                                            fasta_contigs(ref_fasta), out_fa))
         return out_fa
     sys.stderr.write("converting %s\n" % msg)
     try:
-        fh = open(out_fa, "w")
-        for header, seq in fasta_iter(ref_fasta):
-            ########### Reverse ######################
-            fh.write(">r%s\n" % header)
-
-            #if non_cpg_only:
-            #    for ctx in "TAG": # use "ATC" for fwd
-            #        seq = seq.replace('G' + ctx, "A" + ctx)
-            #    for line in wrap(seq):
-            #        print >>fh, line
-            #else:
-            for line in wrap(seq.replace("G", "A")):
-                fh.write(line + '\n')
-
-            ########### Forward ######################
-            fh.write(">f%s\n" % header)
-            for line in wrap(seq.replace("C", "T")):
-                fh.write(line + '\n')
-        fh.close()
+        contigs = convert_fasta_parallel(ref_fasta, out_fa, threads, keep)
+        if contigs is None:
+            # each contig is written as >r (G => A) then >f (C => T)
+            # without reading it into memory.
+            with open(out_fa, "wb") as fh:
+                contigs = convert_fasta_stream(nopen_bytes(ref_fasta), fh,
+                                     tmp_dir=op.dirname(op.abspath(out_fa)),
+                                     keep=keep)
     except:
-        try:
-            fh.close()
-        except UnboundLocalError:
-            pass
-        os.unlink(out_fa)
+        if op.exists(out_fa):
+            os.unlink(out_fa)
         raise
+    if contig_filter is not None:
+        skipped = sorted(set(contig_filter.skipped))
+        sys.stderr.write("converted %d contigs, skipped %d%s\n" % (
+                         len(contigs), len(skipped), skipped and
+                         " (e.g. %s)" % ", ".join(skipped[:5]) or ""))
+    if not contigs:
+        os.unlink(out_fa)
+        raise BWAMethException("no contigs of %s were converted" % ref_fasta)
+    new = new_manifest(ref_fasta, contigs, out_fa)
+    new["filter"] = record
+    if manifest is not None and \
+            manifest["converted"]["sha1"] == new["converted"]["sha1"]:
+        # same output, so the indexes of it are still good.
+        new["indexes"] = manifest["indexes"]
+    write_manifest(out_fa, new)
+    write_alt(ref_fasta, out_fa, contigs)
     return out_fa
 
+# the files made by bwa index and bwa-mem2 index
+INDEX_FILES = {"mem": (".amb", ".ann", ".bwt", ".pac", ".sa"),
+               "mem2": (".0123", ".amb", ".ann", ".bwt.2bit.64", ".pac")}
+
+def aligner_version(ver="mem"):
+    "the version reported by bwa or bwa-mem2, or None"
+    cmd = ["bwa"] if ver == "mem" else ["bwa-mem2", "version"]
+    try:
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    except OSError:
+        return None
+    text = b"".join(p.communicate()).decode("utf-8", "replace")
+    m = re.search(r"Version: (\S+)", text)
+    if m:
+        return m.group(1)
+    lines = text.strip().split("\n")
+    return lines[-1].strip() or None
+
+def index_record(fa, ver, manifest):
+    "the manifest entry for the `INDEX_FILES` of fa"
+    return {"converted": manifest["converted"]["sha1"],
+            "version": aligner_version(ver),
+            "files": dict((ext, op.getsize(fa + ext))
+                          for ext in INDEX_FILES[ver] if op.exists(fa + ext))}
+
+def index_current(fa, ver, manifest):
+    """
+    whether the manifest has a ver index of the current converted fasta
+    and its files are all there with the recorded sizes.
+    """
+    rec = manifest and manifest["indexes"].get(ver)
+    if not rec or rec["converted"] != manifest["converted"]["sha1"]:
+        return False
+    if set(INDEX_FILES[ver]) - set(rec["files"]):
+        return False
+    return all(op.exists(fa + ext) and op.getsize(fa + ext) == size
+               for ext, size in rec["files"].items())
+
+def index_usable(conv_fa, ver, manifest):
+    """
+    whether the ver index of conv_fa is there and, if the manifest has a
+    record of it, was built from the current converted fasta. indexes made
+    before there were manifests are checked by mtime.
+    """
+    if not all(op.exists(conv_fa + ext) for ext in INDEX_FILES[ver]):
+        return False
+    if manifest is None or ver not in manifest["indexes"]:
+        return is_newer_b(conv_fa, [conv_fa + ext for ext in INDEX_FILES[ver]])
+    # the size is cheap to check; digests are left to `convert_fasta`.
+    return op.getsize(conv_fa) == manifest["converted"]["size"] and \
+            index_current(conv_fa, ver, manifest)
+
+ALIGNERS = {"bwa": "mem", "bwa-mem2": "mem2"}
+
+def find_index(conv_fa, aligner="auto"):
+    """
+    the index flavour, "mem" (bwa) or "mem2" (bwa-mem2), to align to
+    conv_fa with. aligner is "auto", "bwa" or "bwa-mem2". auto prefers
+    a bwa-mem2 index if bwa-mem2 is installed. None if there is no usable
+    index.
+    """
+    manifest = read_manifest(conv_fa)
+    if aligner != "auto":
+        ver = ALIGNERS[aligner]
+        return ver if index_usable(conv_fa, ver, manifest) else None
+    usable = [ver for ver in ("mem2", "mem")
+              if index_usable(conv_fa, ver, manifest)]
+    if "mem2" in usable and which("bwa-mem2") is None:
+        sys.stderr.write("WARNING: found a bwa-mem2 index but bwa-mem2 is"
+                         " not on the PATH\n")
+        usable.remove("mem2")
+    return usable[0] if usable else None
+
+# resident copies of indexes made by `shm load`. bwa indexes are loaded
+# with bwa shm, which finds them by the basename of the index, so each is
+# loaded through symlinks with a name of its own. bwa-mem2 has no shared
+# memory mode, so its index files are copied to this tmpfs instead.
+SHM_DIR = "/dev/shm/bwameth"
+
+def shm_prefix(conv_fa, ver):
+    "the directory and index prefix of the resident ver index of conv_fa"
+    manifest = read_manifest(conv_fa)
+    if manifest is not None:
+        key = manifest["converted"]["sha1"]
+    else:
+        key = hashlib.sha1(op.abspath(conv_fa).encode()).hexdigest()
+    key = "%s-%s" % (key[:16], ver)
+    return op.join(SHM_DIR, key), op.join(SHM_DIR, key, key + ".c2t")
+
+def bwa_shm_list():
+    "(name, bytes) of the indexes loaded with bwa shm"
+    try:
+        p = Popen(["bwa", "shm", "-l"], stdout=PIPE, stderr=PIPE)
+    except OSError:
+        return []
+    out = p.communicate()[0].decode()
+    return [(l.split("\t")[0], int(l.split("\t")[1])) for l in
+            out.splitlines() if l.count("\t") == 1]
+
+def shm_info(shm_dir):
+    try:
+        with open(op.join(shm_dir, "info.json")) as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+
+def shm_resident(shm_dir, info):
+    "whether the index described by the info of `shm load` is resident"
+    prefix = op.join(shm_dir, info["name"])
+    if info["flavour"] == "mem":
+        return info["name"] in dict(bwa_shm_list())
+    return all(op.exists(prefix + ext) and op.getsize(prefix + ext) == size
+               for ext, size in info["files"].items())
+
+def resident_index(conv_fa, ver):
+    """
+    the prefix of the copy of the ver index of conv_fa that was loaded
+    with `shm load`, or None if it isn't loaded.
+    """
+    shm_dir, prefix = shm_prefix(conv_fa, ver)
+    info = shm_info(shm_dir)
+    if info is None or not shm_resident(shm_dir, info):
+        return None
+    return prefix
+
+def shm_load(fa, aligner="auto"):
+    conv_fa = convert_fasta(fa, just_name=True)
+    ver = find_index(conv_fa, aligner)
+    if ver is None:
+        raise BWAMethException("no usable index of %s to load\n" % conv_fa)
+    if resident_index(conv_fa, ver):
+        sys.stderr.write("already loaded: %s\n" % conv_fa)
+        return
+    shm_dir, prefix = shm_prefix(conv_fa, ver)
+    if not op.isdir(shm_dir):
+        os.makedirs(shm_dir)
+    exts = [e for e in INDEX_FILES[ver] + (".alt",) if op.exists(conv_fa + e)]
+    sys.stderr.write("loading %s into %s\n" % (conv_fa, shm_dir))
+    for ext in exts:
+        if op.lexists(prefix + ext):
+            os.unlink(prefix + ext)
+        if ver == "mem":
+            os.symlink(op.abspath(conv_fa + ext), prefix + ext)
+        else:
+            shutil.copyfile(conv_fa + ext, prefix + ext + ".tmp")
+            os.rename(prefix + ext + ".tmp", prefix + ext)
+    if ver == "mem" and Popen(["bwa", "shm", prefix]).wait() != 0:
+        raise BWAMethException("bwa shm failed to load %s\n" % conv_fa)
+    info = {"name": op.basename(prefix), "flavour": ver,
+            "reference": op.abspath(fa),
+            "files": dict((e, op.getsize(conv_fa + e)) for e in exts)}
+    with open(op.join(shm_dir, "info.json"), "w") as fh:
+        json.dump(info, fh, indent=1, sort_keys=True)
+
+def shm_entries():
+    "(directory, info) of each index loaded with `shm load`"
+    if not op.isdir(SHM_DIR):
+        return []
+    dirs = [op.join(SHM_DIR, d) for d in sorted(os.listdir(SHM_DIR))]
+    return [(d, shm_info(d)) for d in dirs if shm_info(d) is not None]
+
+def shm_drop(entries):
+    "drop the (directory, info) entries from `shm_entries`"
+    drop = set(d for d, _ in entries)
+    if any(i["flavour"] == "mem" and shm_resident(d, i) for d, i in entries):
+        # bwa shm can only drop all indexes, so load the others again.
+        loaded = shm_entries()
+        others = [(d, i) for d, i in loaded if d not in drop
+                  and i["flavour"] == "mem" and shm_resident(d, i)]
+        ours = set(i["name"] for _, i in loaded)
+        for name, _ in bwa_shm_list():
+            if name not in ours:
+                sys.stderr.write("WARNING: also dropping %s, which was"
+                                 " loaded with bwa shm\n" % name)
+        if Popen(["bwa", "shm", "-d"]).wait() != 0:
+            raise BWAMethException("bwa shm -d failed\n")
+        for d, i in others:
+            check_call(["bwa", "shm", op.join(d, i["name"])])
+    for d, info in entries:
+        shutil.rmtree(d)
+        sys.stderr.write("dropped %s\n" % info["reference"])
+
+def shm_main(args):
+    __doc__ = """
+    keep the index of a reference in memory so that bwa does not read it
+    from disk for every sample. `load` it once, then align as usual; the
+    resident copy is found and used automatically.
+    """
+    p = argparse.ArgumentParser(__doc__)
+    p.add_argument("action", choices=("load", "list", "drop"))
+    p.add_argument("--reference", help="reference fasta, as given to index")
+    p.add_argument("--aligner", choices=("auto",) + tuple(sorted(ALIGNERS)),
+            default="auto", help="which index to load (or drop) if there"
+            " are both")
+    p.add_argument("--all", action="store_true", help="drop all indexes")
+    a = p.parse_args(args)
+    if a.action != "list" and not a.reference and not a.all:
+        p.error("a reference is needed to %s" % a.action)
+
+    try:
+        if a.action == "load":
+            shm_load(a.reference, a.aligner)
+        elif a.action == "list":
+            names = dict((v, k) for k, v in ALIGNERS.items())
+            print("#directory\taligner\tloaded\tbytes\treference")
+            for d, info in shm_entries():
+                print("%s\t%s\t%s\t%d\t%s" % (d, names[info["flavour"]],
+                      "yes" if shm_resident(d, info) else "no",
+                      sum(info["files"].values()), info["reference"]))
+        elif a.all:
+            shm_drop(shm_entries())
+        else:
+            conv_fa = convert_fasta(a.reference, just_name=True)
+            dirs = [shm_prefix(conv_fa, ver)[0] for name, ver
+                    in sorted(ALIGNERS.items()) if a.aligner in ("auto", name)]
+            entries = [(d, shm_info(d)) for d in dirs if shm_info(d)]
+            if not entries:
+                sys.stderr.write("not loaded: %s\n" % a.reference)
+                return 1
+            shm_drop(entries)
+    except BWAMethException as e:
+        sys.stderr.write(str(e))
+        return 1
+    return 0
 
 def bwa_index(fa, ver = "mem"):
+    manifest = read_manifest(fa)
+    if index_current(fa, ver, manifest):
+        sys.stderr.write("already indexed: %s\n" % fa)
+        return
+    made = [fa + ext for ext in INDEX_FILES[ver]]
+    if all(op.exists(f) for f in made) and is_newer_b(fa, made) and \
+            not (manifest and ver in manifest["indexes"]):
+        # indexed before there were manifests. record it as it is.
+        if manifest is not None:
+            manifest["indexes"][ver] = index_record(fa, ver, manifest)
+            write_manifest(fa, manifest)
+        return
 
     if ver == "mem":
-        if is_newer_b(fa, (fa + '.amb', fa + '.sa')):
-            return
         sys.stderr.write("indexing with bwa-mem: %s\n" % fa)
-        try:
-            run("bwa index -a bwtsw %s" % fa)
-        except:
-            if op.exists(fa + ".amb"):
-                os.unlink(fa + ".amb")
-            raise
+        cmd = "bwa index -a bwtsw %s" % fa
     else:
-        if is_newer_b(fa, (fa + '.amb', fa + '.pac')):
-            return
         sys.stderr.write("indexing with bwa-mem2: %s\n" % fa)
+        cmd = "bwa-mem2 index %s" % fa
+    try:
+        run(cmd)
+    except:
+        if op.exists(fa + ".amb"):
+            os.unlink(fa + ".amb")
+        raise
+    missing = [f for f in made if not op.exists(f)]
+    if missing:
+        raise BWAMethException("indexing made no %s\n" % " ".join(missing))
+    if manifest is not None:
+        manifest["indexes"][ver] = index_record(fa, ver, manifest)
+        write_manifest(fa, manifest)
+
+# index bundles made by `index-pack`. the files are cut into chunks that
+# are compressed on their own, so a pool of threads can pack or unpack
+# them at once and each chunk is checked with its sha256 as it is written.
+# the layout is:
+#   PACK_MAGIC, the chunks, a json index of the files and their chunks,
+#   then PACK_FOOTER: the offset, length and sha256 of the index, PACK_MAGIC
+PACK_MAGIC = b"BWMPACK1"
+PACK_FOOTER = struct.Struct(">QQ32s8s")
+PACK_CHUNK = 32 << 20
+
+def pread(fd, size, offset):
+    "read size bytes (fewer at the end of the file) from fd at offset"
+    if not hasattr(os, "pread"): # python2
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+    return os.pread(fd, size, offset)
+
+def _pack_chunk(args):
+    path, offset, size, level = args
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        raw = pread(fd, size, offset)
+    finally:
+        os.close(fd)
+    if len(raw) != size:
+        raise BWAMethException("%s changed while it was packed\n" % path)
+    data = zlib.compress(raw, level)
+    # the index files of bwa-mem2 are hardly compressible; keep them as is.
+    if len(data) >= len(raw):
+        return raw, False, hashlib.sha256(raw).hexdigest()
+    return data, True, hashlib.sha256(raw).hexdigest()
+
+def pack_index(fa, out, threads=1, chunk=PACK_CHUNK, level=1,
+               aligner="auto"):
+    """
+    write the converted fasta of fa, its .alt, its manifest and the index
+    files of each flavour (or just that of aligner) that is current to the
+    bundle out.
+    """
+    from multiprocessing.pool import ThreadPool
+    conv_fa = convert_fasta(fa, just_name=True)
+    manifest = read_manifest(conv_fa)
+    if manifest is None or not op.exists(conv_fa) or not \
+            converted_unchanged(conv_fa, manifest["converted"]):
+        raise BWAMethException("%s has not been converted with this version"
+                               " of bwameth.py; run index first\n" % fa)
+    vers = [ver for name, ver in sorted(ALIGNERS.items())
+            if aligner in ("auto", name)
+            and index_current(conv_fa, ver, manifest)]
+    if not vers:
+        raise BWAMethException("no current index of %s to pack\n" % conv_fa)
+    exts = set(ext for ver in vers for ext in INDEX_FILES[ver])
+    exts = [""] + sorted(exts) + [e for e in (".alt",)
+                                  if op.exists(conv_fa + e)]
+    exts.append(".manifest.json")
+
+    files, jobs = [], []
+    for ext in exts:
+        size = op.getsize(conv_fa + ext)
+        files.append({"name": op.basename(conv_fa) + ext, "size": size,
+                      "chunks": []})
+        jobs.extend((conv_fa + ext, i, min(chunk, size - i), level)
+                    for i in range(0, size, chunk))
+    owner = [f for f in files for _ in range(0, f["size"], chunk)]
+
+    sys.stderr.write("packing %s (%s) into %s\n" % (conv_fa,
+                     " and ".join(dict((v, k) for k, v in ALIGNERS.items())[v]
+                                  for v in vers), out))
+    pool = ThreadPool(max(1, threads))
+    try:
+        with open(out + ".tmp", "wb") as fh:
+            fh.write(PACK_MAGIC)
+            # a few chunks at a time so that memory is bounded by threads.
+            step = 2 * max(1, threads)
+            for i in range(0, len(jobs), step):
+                for f, (data, z, digest) in zip(owner[i:i + step],
+                        pool.map(_pack_chunk, jobs[i:i + step])):
+                    f["chunks"].append([fh.tell(), len(data), int(z), digest])
+                    fh.write(data)
+            index = json.dumps({"bwameth": __version__, "chunk": chunk,
+                                "files": files}, sort_keys=True).encode()
+            offset = fh.tell()
+            fh.write(index)
+            fh.write(PACK_FOOTER.pack(offset, len(index),
+                     hashlib.sha256(index).digest(), PACK_MAGIC))
+        os.rename(out + ".tmp", out)
+    except:
+        if op.exists(out + ".tmp"):
+            os.unlink(out + ".tmp")
+        raise
+    finally:
+        pool.terminate()
+    sys.stderr.write("packed %d files, %d bytes into %d bytes\n" % (
+                     len(files), sum(f["size"] for f in files),
+                     op.getsize(out)))
+
+def read_pack_index(path):
+    "the json index of the bundle at path"
+    with open(path, "rb") as fh:
+        fh.seek(0, os.SEEK_END)
+        if fh.tell() < len(PACK_MAGIC) + PACK_FOOTER.size:
+            raise BWAMethException("%s is not an index bundle\n" % path)
+        fh.seek(-PACK_FOOTER.size, os.SEEK_END)
+        offset, size, digest, magic = PACK_FOOTER.unpack(
+                fh.read(PACK_FOOTER.size))
+        fh.seek(0)
+        if magic != PACK_MAGIC or fh.read(len(PACK_MAGIC)) != PACK_MAGIC:
+            raise BWAMethException("%s is not an index bundle\n" % path)
+        fh.seek(offset)
+        index = fh.read(size)
+    if hashlib.sha256(index).digest() != digest:
+        raise BWAMethException("the index of %s is corrupt\n" % path)
+    return json.loads(index.decode())
+
+def _unpack_chunk(args):
+    """
+    write a chunk of the bundle to its place in part. if part already has
+    the right bytes there, e.g. from an unpack that was cut short, they
+    are kept. returns whether the chunk was written.
+    """
+    archive, part, offset, length, (start, size, z, digest), check = args
+    fd = os.open(part, os.O_RDWR)
+    try:
+        if check and hashlib.sha256(pread(fd, length, offset)).hexdigest() \
+                == digest:
+            return False
+        afd = os.open(archive, os.O_RDONLY)
         try:
-            run("bwa-mem2 index %s" % fa)
-        except:
-            if op.exists(fa + ".amb"):
-                os.unlink(fa + ".amb")
-            raise
+            data = pread(afd, size, start)
+        finally:
+            os.close(afd)
+        try:
+            raw = zlib.decompress(data) if z else data
+        except zlib.error:
+            raw = b""
+        if hashlib.sha256(raw).hexdigest() != digest:
+            raise BWAMethException("%s is corrupt: bad chunk at %d\n"
+                                   % (archive, start))
+        pwrite(fd, raw, offset)
+    finally:
+        os.close(fd)
+    return True
+
+def unpack_index(archive, dest=".", threads=1):
+    """
+    unpack the bundle archive into dest with a pool of threads, checking
+    each chunk as it is written. files are written as .part and renamed
+    once all are complete, the manifest last. files already in dest are
+    checked and only the chunks that differ are written again.
+    """
+    from multiprocessing.pool import ThreadPool
+    index = read_pack_index(archive)
+    chunk, files = index["chunk"], index["files"]
+    if not op.isdir(dest):
+        os.makedirs(dest)
+    jobs = []
+    for f in files:
+        path = op.join(dest, f["name"])
+        part = path + ".part"
+        if not op.exists(part) and op.exists(path):
+            os.rename(path, part)
+        check = op.exists(part)
+        with open(part, "ab") as fh:
+            fh.truncate(f["size"])
+        jobs.extend((archive, part, i * chunk, min(chunk, f["size"] - i *
+                     chunk), c, check) for i, c in enumerate(f["chunks"]))
+
+    sys.stderr.write("unpacking %s into %s\n" % (archive, dest))
+    pool = ThreadPool(max(1, threads))
+    try:
+        written = sum(pool.imap_unordered(_unpack_chunk, jobs))
+    finally:
+        pool.terminate()
+    for f in sorted(files, key=lambda f: f["name"].endswith(".manifest.json")):
+        path = op.join(dest, f["name"])
+        os.rename(path + ".part", path)
+    sys.stderr.write("unpacked %d files: wrote %d chunks, %d were already"
+                     " in place\n" % (len(files), written, len(jobs) - written))
+
+    # the converted fasta has a new mtime here; record it so that index
+    # does not hash it again.
+    conv_fa = op.join(dest, files[0]["name"])
+    manifest = read_manifest(conv_fa)
+    if manifest is not None:
+        manifest["converted"].update(file_stat(conv_fa))
+        write_manifest(conv_fa, manifest)
+    return conv_fa
+
+def index_pack_main(args):
+    __doc__ = """
+    bundle the converted fasta, bwa or bwa-mem2 index and manifest of a
+    reference into one file to copy to other machines and unpack there
+    with index-unpack
+    """
+    p = argparse.ArgumentParser(__doc__)
+    p.add_argument("-o", "--output", help="bundle to write. default:"
+            " $fasta.bwameth.c2t.pack")
+    p.add_argument("-t", "--threads", type=int, default=1)
+    p.add_argument("--chunk-size", default="32M", help="bytes compressed at"
+            " a time. each thread holds about two chunks")
+    p.add_argument("-l", "--level", type=int, default=1, choices=range(10),
+            metavar="0-9", help="zlib compression level")
+    p.add_argument("--aligner", choices=("auto",) + tuple(sorted(ALIGNERS)),
+            default="auto", help="which index to pack. auto packs all that"
+            " are current")
+    p.add_argument("fasta")
+    a = p.parse_args(args)
+    out = a.output or convert_fasta(a.fasta, just_name=True) + ".pack"
+    try:
+        pack_index(a.fasta, out, a.threads, parse_size(a.chunk_size),
+                   a.level, a.aligner)
+    except BWAMethException as e:
+        sys.stderr.write(str(e))
+        return 1
+    return 0
+
+def index_unpack_main(args):
+    __doc__ = """
+    unpack a bundle made by index-pack. the reference fasta is then
+    $dir/$fasta with the bundle holding $fasta.bwameth.c2t*
+    """
+    p = argparse.ArgumentParser(__doc__)
+    p.add_argument("-d", "--directory", default=".", help="where to unpack"
+            " the index; this should be where the reference fasta is")
+    p.add_argument("-t", "--threads", type=int, default=1)
+    p.add_argument("bundle")
+    a = p.parse_args(args)
+    try:
+        unpack_index(a.bundle, a.directory, a.threads)
+    except BWAMethException as e:
+        sys.stderr.write(str(e))
+        return 1
+    return 0
+
+Cigar = namedtuple("Cigar", "ops ref_len left right longest_match")
+
+@lru_cache(maxsize=4096)
+def parse_cigar(cigar, _ops=re.compile(r"(\d+)([MIDNSHP=X])")):
+    """
+    the (length, kind) pairs of a cigar along with the reference length, the
+    hard clips on the left and (as a negative slice end, or None) right and
+    the longest match. most reads share a few cigars so these are cached.
+    """
+    if cigar == "*":
+        return Cigar(((0, None),), 0, 0, None, 0)
+    ops = tuple((int(n), kind) for n, kind in _ops.findall(cigar))
+    ref_len = sum(n for n, kind in ops if kind in "MDN=XP")
+    longest = max([n for n, kind in ops if kind == "M"] or [0])
+    left = right = 0
+    for n, kind in ops:
+        if kind == "M": break
+        if kind == "H":
+            left += n
+    for n, kind in reversed(ops):
+        if kind == "M": break
+        if kind == "H":
+            right += n
+    return Cigar(ops, ref_len, left, -right or None, longest)
 
 class Bam(object):
     __slots__ = 'read flag chrom pos mapq cigar chrom_mate pos_mate tlen \
@@ -274,48 +2235,158 @@ class Bam(object):
         return not (self.flag & 0x4)
 
     def cigs(self):
-        if self.cigar == "*":
-            yield (0, None)
-            raise StopIteration
-        cig_iter = groupby(self.cigar, lambda c: c.isdigit())
-        for g, n in cig_iter:
-            yield int("".join(n)), "".join(next(cig_iter)[1])
+        return parse_cigar(self.cigar).ops
 
     def cig_len(self):
-        return sum(c[0] for c in self.cigs() if c[1] in
-                   ("M", "D", "N", "EQ", "X", "P"))
+        return parse_cigar(self.cigar).ref_len
 
     def left_shift(self):
-        left = 0
-        for n, cig in self.cigs():
-            if cig == "M": break
-            if cig == "H":
-                left += n
-        return left
+        return parse_cigar(self.cigar).left
 
     def right_shift(self):
-        right = 0
-        for n, cig in reversed(list(self.cigs())):
-            if cig == "M": break
-            if cig == "H":
-                right += n
-        return -right or None
+        return parse_cigar(self.cigar).right
 
     @property
     def original_seq(self):
         try:
-            return next(x for x in self.other if x.startswith("YS:Z:"))[5:]
+            tag = next(x for x in self.other if x.startswith(("YS:Z:", "YM:Z:")))
+            if tag.startswith("YS:Z:"):
+                return tag[5:]
+            return self._restore_seq(tag[5:])
         except:
             sys.stderr.write(repr(self.other) + "\n")
             sys.stderr.write(self.read + "\n")
             raise
 
+    def _restore_seq(self, mask):
+        """
+        rebuild the original read from the converted SEQ and a YM:Z: mask.
+        hard-clipped bases are filled with N; they are removed again when
+        the read is trimmed to its cigar in `handle_reads`.
+        """
+        if self.seq == "*":
+            return self.seq
+        chars = self.ga_ct[0][5:]
+        left = right = 0
+        if self.is_mapped():
+            left, right = self.left_shift(), -(self.right_shift() or 0)
+        seq = "N" * left + self.seq + "N" * right
+        if not self.is_mapped() or self.is_plus_read():
+            return restore_converted(seq, mask, chars, left, right)
+        # reverse strand: the mask is in the orientation of the read.
+        return restore_converted(comp(seq[::-1]), mask, chars, right, left)
+
     @property
     def ga_ct(self):
         return [x for x in self.other if x.startswith("YC:Z:")]
 
-    def longest_match(self, patt=re.compile(r"\d+M")):
-        return max(int(x[:-1]) for x in patt.findall(self.cigar))
+    def longest_match(self):
+        return parse_cigar(self.cigar).longest_match
+
+    def drop_tag(self, *prefixes):
+        self.other = [x for x in self.other if not x.startswith(prefixes)]
+
+    def add_tag(self, tag):
+        self.other.append(tag)
+
+def _column(i, kind=str):
+    "a column of a `LazyBam`, parsed as kind when it is read"
+    def get(self):
+        return kind(self.fields[i]) if kind is not str else self.fields[i]
+    def set(self, v):
+        self.fields[i] = str(v)
+    return property(get, set)
+
+class LazyBam(Bam):
+    """
+    a `Bam` that keeps the columns of the line as they came from bwa and
+    only parses those that are read. columns that are not changed, and the
+    optional tags, which are kept as one string, are written back as they
+    were.
+    """
+    __slots__ = ("fields", "_flag")
+    def __init__(self, line):
+        self.fields = line.split("\t", 11)
+        if len(self.fields) == 11:
+            self.fields.append("")
+        self._flag = None
+
+    read = _column(0)
+    chrom = _column(2)
+    pos = _column(3, int)
+    mapq = _column(4)
+    cigar = _column(5)
+    chrom_mate = _column(6)
+    pos_mate = _column(7)
+    tlen = _column(8, lambda t: int(float(t)))
+    seq = _column(9)
+    qual = _column(10)
+
+    @property
+    def flag(self):
+        if self._flag is None:
+            self._flag = int(self.fields[1])
+        return self._flag
+
+    @flag.setter
+    def flag(self, v):
+        self._flag = v
+        self.fields[1] = str(v)
+
+    @property
+    def other(self):
+        return self.fields[11].split("\t") if self.fields[11] else []
+
+    @other.setter
+    def other(self, tags):
+        self.fields[11] = "\t".join(tags)
+
+    def __str__(self):
+        return "\t".join(self.fields)
+
+    def _span(self, prefix):
+        "start and end in the tags of the first that starts with prefix"
+        tags = self.fields[11]
+        if tags.startswith(prefix):
+            i = 0
+        else:
+            i = tags.find("\t" + prefix) + 1
+            if i == 0:
+                return None
+        j = tags.find("\t", i)
+        return i, len(tags) if j < 0 else j
+
+    def tag(self, prefix):
+        "the first tag that starts with prefix, e.g. 'YC:Z:', or None"
+        span = self._span(prefix)
+        return span and self.fields[11][span[0]:span[1]]
+
+    @property
+    def original_seq(self):
+        tag = self.tag("YS:Z:") or self.tag("YM:Z:")
+        if tag is None:
+            raise BWAMethException("no YS:Z or YM:Z tag for %s\n" % self.read)
+        if tag.startswith("YS:Z:"):
+            return tag[5:]
+        return self._restore_seq(tag[5:])
+
+    @property
+    def ga_ct(self):
+        tag = self.tag("YC:Z:")
+        return [tag] if tag else []
+
+    def drop_tag(self, *prefixes):
+        for prefix in prefixes:
+            span = self._span(prefix)
+            while span:
+                i, j = span
+                tags = self.fields[11]
+                self.fields[11] = tags[:i - 1] + tags[j:] if i else tags[j + 1:]
+                span = self._span(prefix)
+
+    def add_tag(self, tag):
+        self.fields[11] = self.fields[11] + "\t" + tag if self.fields[11] \
+                          else tag
 
 
 def rname(fq1, fq2=""):
@@ -331,28 +2402,127 @@ def rname(fq1, fq2=""):
         return "".join(a for a, b in zip(name(fq1), name(fq2)) if a == b) or 'bm'
 
 
+def set_pipe_size(fh, size):
+    "grow the kernel buffer of a pipe (linux only, ignored elsewhere)"
+    try:
+        import fcntl
+        fcntl.fcntl(fh.fileno(), getattr(fcntl, "F_SETPIPE_SZ", 1031), size)
+    except (ImportError, IOError, OSError):
+        pass
+
+def _run_converter(c2t_args, out):
+    sys.exit(c2t_main(c2t_args, out=out))
+
+def start_converter(c2t_args, out):
+    """
+    run `c2t_main` with c2t_args in a forked process, writing to out.
+    where fork is not available, a thread is used instead. returns a
+    function that waits for the conversion and gives its exit code. with
+    stop=True, the conversion is abandoned (a thread can't be stopped, but
+    it ends once the reader of out has gone).
+    """
+    import multiprocessing
+    if "fork" in getattr(multiprocessing, "get_all_start_methods",
+                         lambda: ["fork"])():
+        ctx = getattr(multiprocessing, "get_context", lambda m: multiprocessing)
+        proc = ctx("fork").Process(target=_run_converter, args=(c2t_args, out))
+        proc.start()
+        # only the converter should hold the write end of the pipe.
+        out.close()
+        def wait(stop=False):
+            if stop:
+                proc.terminate()
+            proc.join()
+            return proc.exitcode
+        return wait
+
+    import threading
+    result = []
+    def run():
+        try:
+            result.append(c2t_main(c2t_args, out=out))
+        finally:
+            out.close()
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+    def wait(stop=False):
+        if stop:
+            return 1
+        t.join()
+        return result[0] if result else 1
+    return wait
+
 def bwa_mem(fa, fq_convert_cmd, extra_args, threads=1, rg=None,
-            paired=True, set_as_failed=None, do_not_penalize_chimeras=False):
+            paired=True, set_as_failed=None, do_not_penalize_chimeras=False,
+            pipe_size=None, aligner="auto", post_workers=1, **output):
+    """
+    align with bwa or bwa-mem2, as chosen by `find_index`, and
+    post-process its output with `as_bam` in post_workers processes.
+    output holds the options of `as_bam` for the output format.
+    fq_convert_cmd is either a shell command that writes the converted
+    reads or a list of arguments to `c2t_main`. in the latter case, bwa is
+    started directly and fed from a converter in this interpreter; the
+    kernel pipe buffers are set to pipe_size bytes if given.
+    """
     conv_fa = convert_fasta(fa, just_name=True)
-    # Currently use bwa-mem only
-    idx = "mem1"
-    # if is_newer_b(conv_fa, (conv_fa + '.amb', conv_fa + '.sa')):
-    #     idx = "mem1"
-    #     sys.stderr.write("--------------------\n")
-    #     sys.stderr.write("Found BWA MEM index\n")
-        
-    # elif is_newer_b(conv_fa, (conv_fa + '.amb', conv_fa + '.pac')):
-    #     idx = "mem2"
-    #     sys.stderr.write("---------------------\n")
-    #     sys.stderr.write("Found BWA MEM2 index\n")
-        
-    # else:
-    #     raise BWAMethException("first run bwameth.py index %s OR bwameth.py index-mem2 %s OR make sure the modification time on the generated c2t files is newer than on the .fa file" % (fa, fa))
-
+    idx = find_index(conv_fa, aligner)
+    if idx is None and aligner != "auto":
+        raise BWAMethException("no usable %s index of %s. first run"
+                " bwameth.py %s %s" % (aligner, conv_fa, "index-mem2"
+                if aligner == "bwa-mem2" else "index", fa))
+    if idx is None:
+        raise BWAMethException("first run bwameth.py index %s OR bwameth.py index-mem2 %s OR make sure the modification time on the generated c2t files is newer than on the .fa file" % (fa, fa))
+    sys.stderr.write("--------------------\n")
+    sys.stderr.write("Found BWA %s index: %s\n" % (
+                     "MEM2" if idx == "mem2" else "MEM",
+                     " ".join(conv_fa + ext for ext in INDEX_FILES[idx])))
+    resident = resident_index(conv_fa, idx)
+    if resident is not None:
+        sys.stderr.write("using the copy in shared memory: %s\n" % resident)
+        conv_fa = resident
 
     if not rg is None and not rg.startswith('@RG'):
         rg = '@RG\\tID:{rg}\\tSM:{rg}'.format(rg=rg)
 
+    if not isinstance(fq_convert_cmd, str):
+        # penalize clipping and unpaired. lower penalty on mismatches (-B)
+        cmd = ["bwa-mem2" if idx == "mem2" else "bwa", "mem", "-T", "40",
+               "-B", "2", "-L", "10", "-CM"]
+        if paired:
+            cmd += ["-U", "100", "-p"]
+        cmd += ["-R", rg, "-t", str(threads)] + shlex.split(extra_args)
+        cmd += [conv_fa, "/dev/stdin"]
+        sys.stderr.write("running: %s\n" % " ".join(
+                         [shell_quote(x) for x in cmd]))
+        sys.stderr.write("--------------------\n")
+        p = Popen(cmd, stdin=PIPE, stdout=PIPE, bufsize=-1)
+        if pipe_size:
+            set_pipe_size(p.stdin, pipe_size)
+            set_pipe_size(p.stdout, pipe_size)
+        wait_converter = start_converter(fq_convert_cmd, p.stdin)
+        sam = p.stdout
+        if sys.version_info[0] > 2:
+            import io
+            sam = io.TextIOWrapper(sam)
+        try:
+            as_bam(sam, fa, set_as_failed, do_not_penalize_chimeras,
+                   post_workers, **output)
+        except BaseException:
+            # nothing reads from bwa anymore, so it and the converter
+            # feeding it would block forever. stop both before raising.
+            p.stdout.close()
+            p.kill()
+            p.wait()
+            wait_converter(stop=True)
+            raise
+        if wait_converter() != 0:
+            raise BWAMethException("read conversion failed")
+        if p.wait() != 0:
+            raise BWAMethException("bwa failed with exit code %d" %
+                                   p.returncode)
+        return
+
     #starts the pipeline with the program to convert fastqs
     cmd = ("|%s " % fq_convert_cmd)
 
@@ -368,55 +2538,585 @@ def bwa_mem(fa, fq_convert_cmd, extra_args, threads=1, rg=None,
     cmd = cmd.format(**locals())
     sys.stderr.write("running: %s\n" % cmd.lstrip("|"))
     sys.stderr.write("--------------------\n")
-    as_bam(cmd, fa, set_as_failed, do_not_penalize_chimeras)
+    as_bam(cmd, fa, set_as_failed, do_not_penalize_chimeras, post_workers,
+           **output)
+
+
+# BAM output. records are encoded from the columns of a `LazyBam` and the
+# BGZF blocks are deflated by a pool of threads (zlib releases the GIL).
+BAM_BASES = "=ACMGRSVTWYHKDBN"
+BAM_CIGAR_OPS = "MIDNSHP=X"
+BAM_CORE = struct.Struct("<iiBBHHHiiii")
+BAM_TAG_TYPES = {"c": "b", "C": "B", "s": "h", "S": "H", "i": "i", "I": "I",
+                 "f": "f"}
+# bases to their 4-bit codes; anything unknown is N.
+NIBBLES = bytes(bytearray(BAM_BASES.find(chr(c).upper()) % 16
+                          for c in range(256)))
+PHRED = bytes(bytearray((c - 33) % 256 for c in range(256)))
+
+def reg2bin(beg, end):
+    "the bin of the 0-based, half-open region beg-end, as in the SAM spec"
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
 
+@lru_cache(maxsize=4096)
+def cigar_codes(cigar):
+    "the packed ops of a cigar, their number and its length on the reference"
+    ops = [(n, kind) for n, kind in parse_cigar(cigar).ops if kind is not None]
+    codes = struct.pack("<%dI" % len(ops), *[n << 4 | BAM_CIGAR_OPS.index(kind)
+                                             for n, kind in ops])
+    return codes, len(ops), sum(n for n, kind in ops if kind in "MDN=X")
+
+def pack_seq(seq):
+    "a sequence as 4-bit codes, two to a byte"
+    codes = seq.encode().translate(NIBBLES)
+    if len(codes) % 2:
+        codes += b"\0"
+    if not hasattr(int, "from_bytes"): # python2
+        return bytes(bytearray(a << 4 | b for a, b in
+                     zip(bytearray(codes[0::2]), bytearray(codes[1::2]))))
+    # codes are < 16, so shifting the high ones moves each within its byte.
+    packed = int.from_bytes(codes[0::2], "big") << 4 | \
+             int.from_bytes(codes[1::2], "big")
+    return packed.to_bytes(len(codes) // 2, "big")
+
+def int_type(value):
+    "the smallest BAM integer type that holds value"
+    if value < 0:
+        return "c" if value >= -128 else "s" if value >= -32768 else "i"
+    return "C" if value < 256 else "S" if value < 65536 else "I"
+
+def pack_tag(tag):
+    "a SAM tag such as NM:i:1 in its BAM form"
+    key, kind, value = tag[:2], tag[3], tag[5:]
+    if kind == "i":
+        kind = int_type(int(value))
+        return (key + kind).encode() + struct.pack("<" + BAM_TAG_TYPES[kind],
+                                                   int(value))
+    if kind == "f":
+        return (key + "f").encode() + struct.pack("<f", float(value))
+    if kind == "A":
+        return (key + "A" + value).encode()
+    if kind == "B":
+        values = value.split(",")
+        sub, values = values[0], values[1:]
+        conv = float if sub == "f" else int
+        return (key + "B" + sub).encode() + struct.pack("<I%d%s" % (
+                len(values), BAM_TAG_TYPES[sub]), len(values),
+                *[conv(v) for v in values])
+    # Z and H
+    return (key + kind + value).encode() + b"\0"
+
+def bam_header(text):
+    "the BAM header for a sam header and the (name, length) of its @SQ"
+    refs = []
+    for line in text.split("\n"):
+        if line.startswith("@SQ"):
+            tags = dict(t.split(":", 1) for t in line.split("\t")[1:])
+            refs.append((tags["SN"], int(tags["LN"])))
+    text = text.encode()
+    parts = [b"BAM\1", struct.pack("<i", len(text)), text,
+             struct.pack("<i", len(refs))]
+    for name, length in refs:
+        name = name.encode() + b"\0"
+        parts += [struct.pack("<i", len(name)), name, struct.pack("<i", length)]
+    return b"".join(parts), refs
+
+class BamEncoder(object):
+    "encode sam records to BAM, given the (name, length) of each reference"
+    def __init__(self, refs):
+        self.ids = dict((name, i) for i, (name, _) in enumerate(refs))
+
+    def encode(self, fields):
+        "the BAM record of the columns of a `LazyBam`"
+        (name, flag, chrom, pos, mapq, cigar, chrom_mate, pos_mate, tlen, seq,
+         qual, tags) = fields
+        ref = self.ids.get(chrom, -1)
+        mate = ref if chrom_mate == "=" else self.ids.get(chrom_mate, -1)
+        pos = int(pos) - 1
+        codes, n_ops, span = cigar_codes(cigar)
+        if seq == "*":
+            seq, qual = "", b""
+        elif qual == "*":
+            qual = b"\xff" * len(seq)
+        else:
+            qual = qual.encode().translate(PHRED)
+        name = name.encode() + b"\0"
+        data = b"".join([BAM_CORE.pack(ref, pos, len(name), int(mapq),
+                             reg2bin(pos, pos + (span or 1)), n_ops,
+                             int(flag), len(seq), mate, int(pos_mate) - 1,
+                             int(tlen)),
+                         name, codes, pack_seq(seq) if seq else b"", qual]
+                        + [pack_tag(t) for t in tags.split("\t") if t])
+        return struct.pack("<i", len(data)) + data
+
+# the most data in a BGZF block, as used by htslib, and the empty block that
+# marks the end of a file.
+BGZF_BLOCK = 0xff00
+BGZF_EOF = unhexlify("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+def bgzf_block(data, level=6):
+    "data as one BGZF block"
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = c.compress(data) + c.flush()
+    return b"".join([b"\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0",
+                     struct.pack("<H", len(deflated) + 25), deflated,
+                     struct.pack("<II", zlib.crc32(data) & 0xffffffff,
+                                 len(data))])
+
+class BgzfWriter(object):
+    """
+    write BGZF to fh. full blocks are deflated by a pool of threads and
+    written in order; a few per thread are queued before the oldest is
+    waited for. level 0 makes uncompressed BAM, e.g. for a sorter.
+    blocks are cut every BGZF_BLOCK bytes, so with track the file offset
+    of each block is kept for `voffset`.
+    """
+    def __init__(self, fh, level=6, threads=1, track=False):
+        from multiprocessing.pool import ThreadPool
+        self.fh, self.level, self.threads = fh, level, threads
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.pending = deque()
+        self.buf = b""
+        # bytes written before compression and after; block offsets.
+        self.pos = self.written = 0
+        self.offsets = [] if track else None
+
+    def write(self, data):
+        self.pos += len(data)
+        data = self.buf + data
+        end = len(data) - len(data) % BGZF_BLOCK
+        for i in range(0, end, BGZF_BLOCK):
+            self._put(data[i:i + BGZF_BLOCK])
+        self.buf = data[end:]
+
+    def _put(self, data):
+        if self.pool is None:
+            self._write(bgzf_block(data, self.level))
+            return
+        self.pending.append(self.pool.apply_async(bgzf_block,
+                                                  (data, self.level)))
+        if len(self.pending) >= 4 * self.threads:
+            self._write(self.pending.popleft().get())
+
+    def _write(self, block):
+        if self.offsets is not None:
+            self.offsets.append(self.written)
+        self.fh.write(block)
+        self.written += len(block)
+
+    def voffset(self, pos):
+        "the virtual offset of pos, a count of bytes written, once closed"
+        block, within = divmod(pos, BGZF_BLOCK)
+        return self.offsets[block] << 16 | within
+
+    def close(self):
+        if self.buf:
+            self._put(self.buf)
+            self.buf = b""
+        while self.pending:
+            self._write(self.pending.popleft().get())
+        self._write(BGZF_EOF)
+        self.fh.flush()
+        if self.pool is not None:
+            self.pool.terminate()
+
+BAM_HEAD = struct.Struct("<iiiBBHHH")
+
+def bam_records(blob):
+    """
+    (key, record) for each BAM record in blob. keys order records by
+    reference and position with unplaced reads last.
+    """
+    offset = 0
+    while offset < len(blob):
+        size, ref, pos = struct.unpack_from("<iii", blob, offset)
+        end = offset + 4 + size
+        yield (ref % (1 << 32)) << 32 | (pos + 1), blob[offset:end]
+        offset = end
+
+def read_run(path, i):
+    "(key, i, record) for each record in a run written by `BamSorter`"
+    import gzip
+    with gzip.open(path, "rb") as fh:
+        while True:
+            head = fh.read(12)
+            if not head:
+                break
+            size, ref, pos = struct.unpack("<iii", head)
+            yield (ref % (1 << 32)) << 32 | (pos + 1), i, \
+                  head + fh.read(size - 8)
+
+class BamSorter(object):
+    """
+    sort BAM records by coordinate. records are kept until they take about
+    memory bytes; then they are sorted and written to a compressed run in
+    tmp_dir by a thread while the next are collected, so up to twice
+    memory can be in use. `sorted` merges the runs.
+    """
+    def __init__(self, memory, tmp_dir=None, threads=1):
+        self.memory, self.threads = memory, threads
+        self.tmp_dir = tempfile.mkdtemp(prefix="bwameth-sort.", dir=tmp_dir)
+        self.buf, self.size, self.runs = [], 0, []
+        self.spill, self.error = None, None
+
+    def add(self, blob):
+        for rec in bam_records(blob):
+            self.buf.append(rec)
+            # the record and the key and tuple that hold it.
+            self.size += len(rec[1]) + 100
+        if self.size >= self.memory:
+            self._spill()
+
+    def _spill(self):
+        import threading
+        self._wait()
+        path = op.join(self.tmp_dir, "%d.bam" % len(self.runs))
+        self.runs.append(path)
+        self.spill = threading.Thread(target=self._write_run,
+                                      args=(self.buf, path))
+        self.spill.start()
+        self.buf, self.size = [], 0
+
+    def _write_run(self, buf, path):
+        try:
+            buf.sort(key=itemgetter(0))
+            with open(path, "wb") as fh:
+                writer = BgzfWriter(fh, 1, self.threads)
+                for i in range(0, len(buf), 10000):
+                    writer.write(b"".join(r for _, r in buf[i:i + 10000]))
+                writer.close()
+        except Exception as e:
+            self.error = e
+
+    def _wait(self):
+        if self.spill is not None:
+            self.spill.join()
+            self.spill = None
+        if self.error is not None:
+            raise self.error
+
+    def sorted(self):
+        "the records in order"
+        if not self.runs:
+            self.buf.sort(key=itemgetter(0))
+            return (r for _, r in self.buf)
+        if self.buf:
+            self._spill()
+        self._wait()
+        sys.stderr.write("merging %d sorted runs\n" % len(self.runs))
+        runs = [read_run(path, i) for i, path in enumerate(self.runs)]
+        return (r for _, _, r in heapq.merge(*runs))
+
+    def close(self):
+        self._wait()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+# BAI bins and the linear index cover at most 2^29 bases; samtools makes a
+# .csi for longer contigs.
+BAI_MAX = 1 << 29
+
+class BaiIndex(object):
+    "a .bai made from the records of a sorted BAM as they are written"
+    def __init__(self, nrefs):
+        self.bins = [{} for _ in range(nrefs)]
+        self.linear = [[] for _ in range(nrefs)]
+        # first and last offsets, mapped and unmapped reads of each.
+        self.meta = [None] * nrefs
+        self.last = [None] * nrefs
+        self.no_coor = 0
+
+    def add(self, rec, beg, end):
+        "add the record rec, found at offsets beg to end of the BAM"
+        _, ref, pos, l_name, _, bin_, n_ops, flag = \
+                BAM_HEAD.unpack_from(rec, 0)
+        if ref < 0:
+            self.no_coor += 1
+            return
+        ops = struct.unpack_from("<%dI" % n_ops, rec, 36 + l_name)
+        span = sum(code >> 4 for code in ops if code & 0xf in (0, 2, 3, 7, 8))
+        # a chunk grows while records of the same bin follow each other.
+        chunks = self.bins[ref].setdefault(bin_, [])
+        if self.last[ref] == bin_ and chunks[-1][1] == beg:
+            chunks[-1][1] = end
+        else:
+            chunks.append([beg, end])
+        self.last[ref] = bin_
+        linear = self.linear[ref]
+        last_window = (pos + (span or 1) - 1) >> 14
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for w in range(pos >> 14, last_window + 1):
+            if linear[w] is None:
+                linear[w] = beg
+        meta = self.meta[ref] = self.meta[ref] or [beg, end, 0, 0]
+        meta[1] = end
+        meta[3 if flag & 0x4 else 2] += 1
+
+    def write(self, path, voffset):
+        "write the index with offsets converted by voffset"
+        parts = [b"BAI\1", struct.pack("<i", len(self.bins))]
+        for bins, linear, meta in zip(self.bins, self.linear, self.meta):
+            parts.append(struct.pack("<i", len(bins) + (meta is not None)))
+            for bin_ in sorted(bins):
+                chunks = bins[bin_]
+                parts.append(struct.pack("<Ii", bin_, len(chunks)))
+                parts.extend(struct.pack("<QQ", voffset(b), voffset(e))
+                             for b, e in chunks)
+            if meta is not None:
+                parts.append(struct.pack("<IiQQQQ", 37450, 2, voffset(meta[0]),
+                             voffset(meta[1]), meta[2], meta[3]))
+            # windows without a record start where the one before does.
+            parts.append(struct.pack("<i", len(linear)))
+            prev = 0
+            for offset in linear:
+                prev = voffset(offset) if offset is not None else prev
+                parts.append(struct.pack("<Q", prev))
+        parts.append(struct.pack("<Q", self.no_coor))
+        with open(path + ".tmp", "wb") as fh:
+            fh.write(b"".join(parts))
+        os.rename(path + ".tmp", path)
+
+def coordinate_header(text):
+    "the sam header text with SO:coordinate in its @HD line"
+    lines = text.split("\n")
+    if lines[0].startswith("@HD"):
+        fields = [f for f in lines[0].split("\t") if not f.startswith("SO:")]
+        lines[0] = "\t".join(fields + ["SO:coordinate"])
+    else:
+        lines.insert(0, "@HD\tVN:1.6\tSO:coordinate")
+    return "\n".join(lines)
 
-def as_bam(pfile, fa, set_as_failed=None, do_not_penalize_chimeras=False):
+def as_bam(pfile, fa, set_as_failed=None, do_not_penalize_chimeras=False,
+           workers=1, out_format="sam", level=6, out_threads=1, path=None,
+           sort=None, memory=768 << 20, tmp_dir=None, seqs_per_slice=10000,
+           slices_per_container=1):
     """
-    pfile: either a file or a |process to generate sam output
+    pfile: either a file or a |process to generate sam output, or an open
+           file of sam lines
     fa: the reference fasta
     set_as_failed: None, 'f', or 'r'. If 'f'. Reads mapping to that strand
                       are given the sam flag of a failed QC alignment (0x200).
+    workers: number of processes that post-process the alignments.
+    out_format: 'sam', 'bam', 'ubam' (uncompressed bam) or 'cram'.
+    level, out_threads: compression level and threads for 'bam' (threads
+          of samtools for 'cram').
+    path: file to write to instead of stdout.
+    sort: None or 'coordinate' to sort bam output with a `BamSorter` using
+          memory bytes and tmp_dir. a .bai (.crai) is made when writing
+          to path.
+    seqs_per_slice, slices_per_container: the layout of 'cram'.
     """
-    sam_iter = nopen_keep_parent_stdin(pfile, 'r')
-
+    if isinstance(pfile, str):
+        sam_iter = nopen_keep_parent_stdin(pfile, 'r')
+    else:
+        sam_iter = pfile
+
+    # the contigs that were converted, to check that bwa used an index of
+    # the same ones.
+    manifest = read_manifest(convert_fasta(fa, just_name=True))
+    expected = manifest and [(c[0].split()[0], c[1]) for c in
+                             manifest["source"]["contigs"] if c[1]]
+    sqs = []
+    header = StringIO()
     for line in sam_iter:
         if not line[0] == "@": break
-        handle_header(line)
+        sq = handle_header(line, header)
+        if sq is not None and sq[1]:
+            sqs.append(sq)
     else:
         sys.stderr.flush()
         raise Exception("bad or empty fastqs")
-    sam_iter2 = (x.rstrip().split("\t") for x in chain([line], sam_iter))
-    for read_name, pair_list in groupby(sam_iter2, itemgetter(0)):
-        pair_list = [Bam(toks) for toks in pair_list]
+    if expected and sqs != expected:
+        diff = [c for c in set(sqs) ^ set(expected)] or sqs[:1]
+        raise BWAMethException("the @SQ lines from bwa do not match the"
+                " contigs in the manifest of the index (e.g. %s:%d). the"
+                " index may be out of date; run bwameth.py index %s"
+                % (diff[0] + (fa,)))
+
+    encoder = writer = sorter = index = cram = None
+    if out_format == "sam":
+        out = open(path, "w") if path else sys.stdout
+        out.write(header.getvalue())
+        write = out.write
+    else:
+        text = header.getvalue()
+        if sort:
+            text = coordinate_header(text)
+        data, refs = bam_header(text)
+        encoder = BamEncoder(refs)
+        out = open(path, "wb") if path else getattr(sys.stdout, "buffer",
+                                                    sys.stdout)
+        if out_format == "cram":
+            cram = start_cram(out, fa, out_threads, seqs_per_slice,
+                              slices_per_container)
+        elif sort and path and all(length <= BAI_MAX for _, length in refs):
+            index = BaiIndex(len(refs))
+        writer = BgzfWriter(cram.stdin if cram else out,
+                            level if out_format == "bam" else 0,
+                            out_threads if out_format == "bam" else 1,
+                            track=index is not None)
+        writer.write(data)
+        write = writer.write
+        if sort:
+            sorter = BamSorter(memory, tmp_dir, out_threads)
+            write = sorter.add
+    handle = partial(handle_chunk, set_as_failed=set_as_failed,
+                     do_not_penalize_chimeras=do_not_penalize_chimeras,
+                     encoder=encoder)
+    chunks = sam_chunks(chain([line], sam_iter))
+    if workers <= 1:
+        for chunk in chunks:
+            write(handle(chunk))
+    else:
+        import multiprocessing
+        sys.stdout.flush()
+        pool = multiprocessing.Pool(workers)
+        # a few chunks per worker are queued so bwa's output is not read
+        # into memory faster than it is handled; results are written in
+        # order.
+        pending = deque()
+        try:
+            for chunk in chunks:
+                pending.append(pool.apply_async(handle, (chunk,)))
+                if len(pending) >= 4 * workers:
+                    write(pending.popleft().get())
+            while pending:
+                write(pending.popleft().get())
+        finally:
+            pool.terminate()
+    if sorter is not None:
+        try:
+            write_sorted(sorter.sorted(), writer, index)
+        finally:
+            sorter.close()
+    if writer is not None:
+        writer.close()
+    if cram is not None:
+        cram.stdin.close()
+        if cram.wait() != 0:
+            raise BWAMethException("samtools failed to write cram\n")
+    if path:
+        out.close()
+    if index is not None:
+        index.write(path + ".bai", writer.voffset)
+    elif sort and path:
+        check_call(["samtools", "index"] + ([] if cram else ["-c"]) + [path])
+
+def start_cram(out, fa, threads=1, seqs_per_slice=10000,
+               slices_per_container=1):
+    """
+    start samtools to turn uncompressed bam on its stdin into cram against
+    the original reference fa, written to out.
+    """
+    cmd = ["samtools", "view", "-C", "-T", fa, "-@", str(threads),
+           "--output-fmt-option", "seqs_per_slice=%d" % seqs_per_slice,
+           "--output-fmt-option",
+           "slices_per_container=%d" % slices_per_container, "-"]
+    sys.stderr.write("writing cram with: %s\n" % " ".join(
+                     shell_quote(x) for x in cmd))
+    return Popen(cmd, stdin=PIPE, stdout=out)
+
+def write_sorted(records, writer, index=None, batch=10000):
+    "write records to writer in batches, adding each to index"
+    pos = writer.pos
+    while True:
+        recs = list(islice(records, batch))
+        if not recs:
+            break
+        if index is not None:
+            for rec in recs:
+                index.add(rec, pos, pos + len(rec))
+                pos += len(rec)
+        writer.write(b"".join(recs))
 
-        for aln in handle_reads(pair_list, set_as_failed, do_not_penalize_chimeras):
-            sys.stdout.write(str(aln) + '\n')
+POST_CHUNK = 2000
+
+def sam_chunks(lines, size=POST_CHUNK):
+    """
+    lists of about size sam lines. chunks are only cut where the read name
+    changes, so all alignments of a pair are in the same chunk.
+    """
+    chunk, name = [], None
+    for line in lines:
+        if len(chunk) >= size and not line.startswith(name):
+            yield chunk
+            chunk = []
+        chunk.append(line)
+        name = line[:line.find("\t") + 1]
+    if chunk:
+        yield chunk
+
+def handle_chunk(lines, set_as_failed=None, do_not_penalize_chimeras=False,
+                 encoder=None):
+    """
+    the sam text for a chunk of lines from bwa, as made by `handle_reads`,
+    or the BAM records if given a `BamEncoder`.
+    """
+    alns = (LazyBam(x.rstrip()) for x in lines)
+    out = []
+    for read_name, pair_list in groupby(alns, attrgetter("read")):
+        for aln in handle_reads(list(pair_list), set_as_failed,
+                                do_not_penalize_chimeras):
+            out.append(encoder.encode(aln.fields) if encoder else
+                       str(aln) + "\n")
+    return b"".join(out) if encoder else "".join(out)
 
 def handle_header(line, out=sys.stdout):
+    """
+    write a header line from bwa with the converted contigs back to the
+    names of the reference. returns (name, length) for @SQ lines.
+    """
     toks = line.rstrip().split("\t")
+    sq_len = None
     if toks[0].startswith("@SQ"):
-        sq, sn, ln = toks  # @SQ    SN:fchr11    LN:122082543
+        sq, sn, ln = toks[:3]  # @SQ    SN:fchr11    LN:122082543
         # we have f and r, only print out f
         chrom = sn.split(":", 1)[1]
         if chrom.startswith('r'): return
         chrom = chrom[1:]
-        toks = ["%s\tSN:%s\t%s" % (sq, chrom, ln)]
+        # keep extra fields, e.g. AH:* for alt contigs
+        toks = ["%s\tSN:%s\t%s" % (sq, chrom, ln)] + toks[3:]
+        sq_len = (chrom, int(ln.split(":", 1)[1]))
     if toks[0].startswith("@PG"):
         #out.write("\t".join(toks) + "\n")
         toks = ["@PG\tID:bwa-meth\tPN:bwa-meth\tVN:%s\tCL:\"%s\"" % (
                          __version__,
                          " ".join(x.replace("\t", "\\t") for x in sys.argv))]
     out.write("\t".join(toks) + "\n")
+    return sq_len
+
 
+def fill_unsequenced(alns, origs):
+    """
+    a YM:Z: mask can't give back the read of a record without a SEQ (bwa
+    writes '*' for secondary alignments), so take it from another record
+    of the same read that has it. the '*' is kept if there is none.
+    """
+    full = {}
+    for aln, seq in zip(alns, origs):
+        if seq != "*" and "H" not in aln.cigar:
+            full.setdefault(aln.flag & 0xc0, seq)
+    return [full.get(aln.flag & 0xc0, seq) if seq == "*" else seq
+            for aln, seq in zip(alns, origs)]
 
 def handle_reads(alns, set_as_failed, do_not_penalize_chimeras):
 
-    for aln in alns:
-        orig_seq = aln.original_seq
+    origs = [aln.original_seq for aln in alns]
+    if "*" in origs:
+        origs = fill_unsequenced(alns, origs)
+    for aln, orig_seq in zip(alns, origs):
         assert len(aln.seq) == len(aln.qual), aln.read
+        read_len = len(orig_seq)
+        if orig_seq == "*":
+            # the length is still known from the mask's bits.
+            mask = next(x for x in aln.other if x.startswith("YM:Z:"))
+            read_len = int(mask[5:], 16).bit_length() - 1
         # don't need this any more.
-        aln.other = [x for x in aln.other if not x.startswith('YS:Z')]
+        aln.drop_tag('YS:Z', 'YM:Z')
 
         if not aln.is_mapped():
             aln.seq = orig_seq
@@ -429,7 +3129,7 @@ def handle_reads(alns, set_as_failed, do_not_penalize_chimeras):
         aln.chrom = aln.chrom[1:]
 
         assert direction in 'fr', (direction, aln)
-        aln.other.append('YD:Z:' + direction)
+        aln.add_tag('YD:Z:' + direction)
 
         if set_as_failed == direction:
             aln.flag |= 0x200
@@ -438,7 +3138,7 @@ def handle_reads(alns, set_as_failed, do_not_penalize_chimeras):
         # here we have a heuristic that if the longest match is not 44% of the
         # sequence length, we mark it as failed QC and un-pair it. At the end
         # of the loop we set all members of this pair to be unmapped
-            if aln.longest_match() < (len(orig_seq) * 0.44):
+            if aln.longest_match() < (read_len * 0.44):
                 aln.flag |= 0x200  # fail qc
                 aln.flag &= (~0x2) # un-pair
                 aln.mapq = min(int(aln.mapq), 1)
@@ -449,7 +3149,9 @@ def handle_reads(alns, set_as_failed, do_not_penalize_chimeras):
 
         # adjust the original seq to the cigar
         l, r = aln.left_shift(), aln.right_shift()
-        if aln.is_plus_read():
+        if orig_seq == "*":
+            aln.seq = orig_seq
+        elif aln.is_plus_read():
             aln.seq = orig_seq[l:r]
         else:
             aln.seq = comp(orig_seq[::-1][l:r])
@@ -500,24 +3202,327 @@ write.table(df, row.names=FALSE, quote=FALSE, sep="\t")
             print("\t".join(d))
 
 
-def convert_fqs(fqs):
+def index_main(args, ver="mem"):
+    __doc__ = """
+    convert a reference fasta and index it with bwa mem or bwa-mem2
+    """
+    p = argparse.ArgumentParser(__doc__)
+    p.add_argument("-t", "--threads", type=int, default=1, help="processes"
+            " used to convert the fasta. this needs an uncompressed fasta"
+            " with a .fai (one is made if missing)")
+    g = p.add_argument_group("contigs", "convert only some of the contigs,"
+            " e.g. to leave out decoys. contigs listed in $fasta.alt are"
+            " marked as alt contigs for bwa")
+    g.add_argument("--include", help="regular expression matching the names"
+            " of the contigs to keep, e.g. '^chr[0-9XYM]+$'")
+    g.add_argument("--exclude", help="regular expression matching the names"
+            " of the contigs to leave out, e.g. '_decoy$|^chrEBV$'")
+    g.add_argument("--contigs", help="file with the name of a contig to keep"
+            " on each line")
+    g.add_argument("--min-contig-length", type=int, default=0,
+            help="leave out contigs shorter than this")
+    p.add_argument("fasta")
+    a = p.parse_args(args)
+    contig_filter = None
+    if a.include or a.exclude or a.contigs or a.min_contig_length:
+        contig_filter = ContigFilter(a.include, a.exclude, a.contigs,
+                                     a.min_contig_length)
+    try:
+        conv_fa = convert_fasta(a.fasta, threads=a.threads,
+                                contig_filter=contig_filter)
+    except BWAMethException as e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+    return bwa_index(conv_fa, ver=ver)
+
+
+TRIM_ARGS = ("adapter", "adapter2", "trim-quality", "clip-r1", "clip-r2",
+             "three-prime-clip-r1", "three-prime-clip-r2", "min-length")
+
+def add_trim_args(p):
+    g = p.add_argument_group("trimming", "trim reads before they are"
+            " converted. the YS:Z: tag holds the trimmed read")
+    g.add_argument("--adapter", help="adapter to remove from read 1 (and"
+            " read 2 unless --adapter2 is given), e.g. AGATCGGAAGAGC")
+    g.add_argument("--adapter2", help="adapter to remove from read 2")
+    g.add_argument("--trim-quality", type=int, default=0, help="trim low"
+            " quality 3' ends with this phred cutoff")
+    g.add_argument("--clip-r1", type=int, default=0, help="remove this"
+            " many bases from the 5' end of read 1")
+    g.add_argument("--clip-r2", type=int, default=0, help="remove this"
+            " many bases from the 5' end of read 2")
+    g.add_argument("--three-prime-clip-r1", type=int, default=0,
+            help="remove this many bases from the 3' end of read 1")
+    g.add_argument("--three-prime-clip-r2", type=int, default=0,
+            help="remove this many bases from the 3' end of read 2")
+    g.add_argument("--min-length", type=int, default=20, help="drop reads"
+            " (and their mates) shorter than this after trimming")
+
+def trimmer_from_args(a):
+    "a Trimmer from the options of `add_trim_args`, or None if not trimming"
+    if not (a.adapter or a.adapter2 or a.trim_quality or a.clip_r1 or
+            a.clip_r2 or a.three_prime_clip_r1 or a.three_prime_clip_r2):
+        return None
+    return Trimmer(adapters=(a.adapter, a.adapter2 or a.adapter),
+                   quality=a.trim_quality,
+                   clip5=(a.clip_r1, a.clip_r2),
+                   clip3=(a.three_prime_clip_r1, a.three_prime_clip_r2),
+                   min_length=a.min_length)
+
+def add_shard_args(p):
+    p.add_argument("--shard", type=parse_shard, help="only use shard i/N of"
+            " the reads, e.g. 2/8, so that one sample can be split across"
+            " machines. the outputs can be combined with `gather`")
+    p.add_argument("--shard-by", choices=("records", "bytes"),
+            default="records", help="records deals out runs of %d reads"
+            " (or pairs) in turn and works for any input; bytes reads only"
+            " 1/N of each file but needs uncompressed single-end or"
+            " interleaved fastqs" % SHARD_CHUNK)
+
+def c2t_main(args, out=sys.stdout):
+    __doc__ = """
+    convert reads for alignment to the bisulfite converted reference
+    """
+    p = argparse.ArgumentParser(__doc__)
+    p.add_argument("-t", "--threads", type=int, default=1,
+            help="number of processes used to convert reads")
+    p.add_argument("--backend", choices=("python", "numpy"), default="python",
+            help="engine for the per-base conversion. numpy is used only"
+            " if it is installed")
+    p.add_argument("--decompressor", default="auto",
+            choices=("auto", "python", "thread") + tuple(DECOMPRESSORS),
+            help="how gzipped fastqs are decompressed. 'python' is the"
+            " gzip module in the converting process")
+    p.add_argument("--compact-tag", action="store_true",
+            help="store a YM:Z: mask of converted bases instead of a YS:Z:"
+            " copy of each read")
+    p.add_argument("--cache-dir", help="directory to keep converted reads in."
+            " when the same fastqs are converted again, they are read from"
+            " here")
+    p.add_argument("--cache-size", default="100G", help="remove the least"
+            " recently used reads from --cache-dir above this size")
+    add_trim_args(p)
+    p.add_argument("--stats", help="write read-length histograms, base"
+            " composition by position and C/T, G/A ratios to this json file")
+    add_shard_args(p)
+    p.add_argument("fq1s")
+    p.add_argument("fq2s")
+
+    a = p.parse_args(args)
+    return convert_reads(a.fq1s, a.fq2s, out=out, threads=a.threads,
+                         backend=a.backend, decompressor=a.decompressor,
+                         compact=a.compact_tag, cache_dir=a.cache_dir,
+                         cache_size=parse_size(a.cache_size),
+                         trimmer=trimmer_from_args(a), stats_file=a.stats,
+                         shard=a.shard, shard_by=a.shard_by)
+
+def shard_main(args):
+    __doc__ = """
+    split fastqs into shards that keep pairs together. shard i of N holds
+    the same reads that are aligned with --shard i/N
+    """
+    p = argparse.ArgumentParser(__doc__)
+    p.add_argument("-n", "--shards", type=int, required=True)
+    p.add_argument("--by", choices=("records", "bytes"), default="records",
+            help="see --shard-by")
+    p.add_argument("-o", "--prefix", required=True, help="shards are written"
+            " to $prefix.$iof$N.fastq or, for paired files, to"
+            " $prefix.$iof$N.R1.fastq and .R2.fastq")
+    p.add_argument("--gzip", action="store_true", help="gzip the shards")
+    p.add_argument("--decompressor", default="auto",
+            choices=("auto", "python", "thread") + tuple(DECOMPRESSORS))
+    p.add_argument("fastqs", nargs="+", help="fastqs as given for alignment")
+    a = p.parse_args(args)
+    fq1s, fq2s = c2t_inputs(a.fastqs)
+    reads = ["R1", "R2"] if len(a.fastqs) > 1 else [""]
+    if a.by == "bytes" and len(reads) > 1:
+        sys.stderr.write("can not shard paired fastqs by bytes, use records\n")
+        return 1
+
+    import gzip
+    def fopen(i, r):
+        name = "%s.%dof%d%s.fastq" % (a.prefix, i + 1, a.shards,
+                                      r and "." + r)
+        if a.gzip:
+            return gzip.open(name + ".gz", "wb", compresslevel=4)
+        return open(name, "wb")
+    outs = [[fopen(i, r) for r in reads] for i in range(a.shards)]
+
+    try:
+        if a.by == "records":
+            blocks = read_blocks(fq1s, fq2s, decompressor=a.decompressor)
+            for i, r1, r2, _ in deal_blocks(blocks, a.shards):
+                outs[i][0].write(r1)
+                if r2 is not None:
+                    outs[i][1].write(r2)
+        else:
+            for path in fq1s.split(","):
+                with open(path, "rb") as fh:
+                    lines = FastqBlocks(fh).peek_lines(5)
+                lpu = 8 if looks_interleaved(lines) else 4
+                for i in range(a.shards):
+                    fh = RangeReader(path, *shard_range(path, i, a.shards, lpu))
+                    for chunk in iter(lambda: fh.read(BLOCK_SIZE), b""):
+                        outs[i][0].write(chunk)
+                    fh.fh.close()
+    except BWAMethException as e:
+        sys.stderr.write(str(e))
+        return 1
+    finally:
+        for out in chain.from_iterable(outs):
+            out.close()
+    return 0
+
+def sam_header(path):
+    "header text of a sam, bam or cram file"
+    p = Popen(["samtools", "view", "-H", path], stdout=PIPE)
+    header = p.stdout.read().decode()
+    if p.wait() != 0:
+        raise BWAMethException("could not read the header of %s\n" % path)
+    return header
+
+def merge_headers(headers):
+    """
+    one header from the (path, header) of each shard. the @SQ lines must
+    agree. read groups that share an ID must be the same and @PG IDs that
+    clash are given a suffix, which is also used by the PP: fields that
+    refer to them.
+    """
+    hd, sqs, rest = None, None, []
+    rgs, pgs, seen = {}, set(), {}
+    for path, header in headers:
+        lines = [l for l in header.split("\n") if l]
+        # the @PG lines of this header with new IDs and PP: fields. a line
+        # that is the same as one from an earlier header once its PP: is
+        # rewritten is not repeated.
+        pg = dict((l.split("ID:", 1)[1].split("\t")[0], l.split("\t"))
+                  for l in lines if l.startswith("@PG"))
+        ids, added = {}, {}
+        def resolve(pg_id):
+            if pg_id not in ids:
+                ids[pg_id] = pg_id  # stops a PP: cycle
+                fields = [f[:3] + resolve(f[3:]) if f[:3] == "PP:" and
+                          f[3:] in pg else f for f in pg[pg_id]]
+                key = "\t".join(fields)
+                if key not in seen:
+                    new_id, i = pg_id, 1
+                    while new_id in pgs:
+                        new_id = "%s.%d" % (pg_id, i)
+                        i += 1
+                    pgs.add(new_id)
+                    seen[key] = new_id
+                    added[pg_id] = "\t".join("ID:" + new_id if f[:3] == "ID:"
+                                             else f for f in fields)
+                ids[pg_id] = seen[key]
+            return ids[pg_id]
+        for pg_id in pg:
+            resolve(pg_id)
+        sq = [tuple(f for f in l.split("\t") if f[:3] in ("SN:", "LN:"))
+              for l in lines if l.startswith("@SQ")]
+        if sqs is None:
+            first, sqs = path, sq
+            rest.extend(l for l in lines if l.startswith("@SQ"))
+        elif sq != sqs:
+            diff = next((a, b) for a, b in zip_longest(sqs, sq) if a != b)
+            raise BWAMethException("@SQ lines of %s and %s differ: %s != %s\n"
+                    % (first, path, "\t".join(diff[0] or ("none",)),
+                       "\t".join(diff[1] or ("none",))))
+        for l in lines:
+            tag = l[:3]
+            if tag == "@HD":
+                hd = hd or l
+            elif tag == "@RG":
+                rg_id = l.split("ID:", 1)[1].split("\t")[0]
+                if rgs.setdefault(rg_id, l) != l:
+                    raise BWAMethException("read group %s differs in %s\n"
+                                           % (rg_id, path))
+                if l not in rest:
+                    rest.append(l)
+            elif tag == "@PG":
+                pg_id = l.split("ID:", 1)[1].split("\t")[0]
+                if pg_id in added:
+                    rest.append(added.pop(pg_id))
+            elif tag == "@CO" and l not in rest:
+                rest.append(l)
+    return "\n".join(([hd] if hd else []) + rest) + "\n"
+
+def gather_main(args):
+    __doc__ = """
+    merge the alignments of each shard into one coordinate sorted file
+    """
+    p = argparse.ArgumentParser(__doc__)
+    p.add_argument("-o", "--output", required=True, help="output .bam or"
+            " .sam")
+    p.add_argument("-t", "--threads", type=int, default=1)
+    p.add_argument("-m", "--memory", default="768M", help="memory per"
+            " thread for samtools sort")
+    p.add_argument("inputs", nargs="+", help="sam, bam or cram of each shard")
+    a = p.parse_args(args)
+
+    fmt = "sam" if a.output.endswith(".sam") else "bam"
+    try:
+        headers = [(f, sam_header(f)) for f in a.inputs]
+        header = merge_headers(headers)
+    except BWAMethException as e:
+        sys.stderr.write(str(e))
+        return 1
+
+    if all("SO:coordinate" in h.split("\n", 1)[0] for _, h in headers):
+        with tempfile.NamedTemporaryFile("w", suffix=".sam") as fh:
+            fh.write(header)
+            fh.flush()
+            return Popen(["samtools", "merge", "-f", "-O", fmt, "-@",
+                          str(a.threads), "-h", fh.name, a.output]
+                         + a.inputs).wait()
+
+    sort = Popen(["samtools", "sort", "-O", fmt, "-@", str(a.threads),
+                  "-m", a.memory, "-o", a.output, "-"], stdin=PIPE)
+    sort.stdin.write(header.encode())
+    sort.stdin.flush()
+    for f in a.inputs:
+        if Popen(["samtools", "view", f], stdout=sort.stdin).wait() != 0:
+            sys.stderr.write("could not read alignments from %s\n" % f)
+            sort.kill()
+            return 1
+    sort.stdin.close()
+    return sort.wait()
+
+
+def c2t_inputs(fqs):
+    return [fqs[0], fqs[1] if len(fqs) > 1
+                    else ','.join(['NA'] * len(fqs[0].split(",")))]
+
+def convert_fqs(fqs, c2t_args=()):
     script = __file__
-    return "%s %s c2t %s %s" % (sys.executable, script, fqs[0],
-               fqs[1] if len(fqs) > 1
-                      else ','.join(['NA'] * len(fqs[0].split(","))))
+    return " ".join(shell_quote(str(x)) for x in
+                    [sys.executable, script, "c2t"] + list(c2t_args)
+                    + c2t_inputs(fqs))
 
 def main(args=sys.argv[1:]):
 
     if len(args) > 0 and args[0] == "index":
-        assert len(args) == 2, ("must specify fasta as 2nd argument")
-        sys.exit(bwa_index(convert_fasta(args[1])))
+        sys.exit(index_main(args[1:]))
 
     if len(args) > 0 and args[0] == "index-mem2":
-        assert len(args) == 2, ("must specify fasta as 2nd argument")
-        sys.exit(bwa_index(convert_fasta(args[1]), ver = "mem2"))
+        sys.exit(index_main(args[1:], ver = "mem2"))
 
     if len(args) > 0 and args[0] == "c2t":
-        sys.exit(convert_reads(args[1], args[2]))
+        sys.exit(c2t_main(args[1:]))
+
+    if len(args) > 0 and args[0] == "index-pack":
+        sys.exit(index_pack_main(args[1:]))
+
+    if len(args) > 0 and args[0] == "index-unpack":
+        sys.exit(index_unpack_main(args[1:]))
+
+    if len(args) > 0 and args[0] == "shm":
+        sys.exit(shm_main(args[1:]))
+
+    if len(args) > 0 and args[0] == "shard":
+        sys.exit(shard_main(args[1:]))
+
+    if len(args) > 0 and args[0] == "gather":
+        sys.exit(gather_main(args[1:]))
 
     if len(args) > 0 and args[0] == "cnvs":
         sys.exit(cnvs_main(args[1:]))
@@ -534,6 +3539,62 @@ def main(args=sys.argv[1:]):
             " reads to align to the original-bottom (OB) strand and will flag"
             " as failed those aligning to the forward, or original top (OT).",
         default=None, choices=('f', 'r'))
+    p.add_argument("--aligner", choices=("auto",) + tuple(sorted(ALIGNERS)),
+            default="auto", help="aligner to use. auto uses bwa-mem2 if"
+            " there is an index for it (from index-mem2), otherwise bwa")
+    p.add_argument("--output", help="file to write instead of stdout")
+    p.add_argument("--output-format", choices=("sam", "bam", "ubam", "cram"),
+            help="format of the output (default: sam, or bam with --sort)."
+            " ubam is uncompressed bam, e.g. to pipe to samtools sort. cram"
+            " is written by samtools against --reference")
+    p.add_argument("--compression-level", type=int, default=6,
+            choices=range(10), metavar="0-9", help="zlib level for"
+            " --output-format bam")
+    p.add_argument("--output-threads", type=int, default=2, help="threads"
+            " that compress --output-format bam or cram")
+    p.add_argument("--cram-seqs-per-slice", type=int, default=10000)
+    p.add_argument("--cram-slices-per-container", type=int, default=1)
+    p.add_argument("--sort", choices=("coordinate",), help="sort the"
+            " alignments (as bam). with --output, a .bai is written too")
+    p.add_argument("--sort-memory", default="768M", help="memory for sorted"
+            " runs before they are written to --tmp-dir and merged")
+    p.add_argument("--tmp-dir", help="directory for the runs of --sort"
+            " (default: $TMPDIR)")
+    p.add_argument("--post-workers", type=int, default=1, help="number of"
+            " processes that handle the alignments from bwa (strand, original"
+            " reads and chimera QC). increase this if the post-processing"
+            " can't keep up with bwa at high --threads")
+    p.add_argument("--c2t-threads", type=int, default=1, help="number of"
+            " processes used to convert reads before they are sent to bwa."
+            " increase this if bwa is waiting on input at high --threads")
+    p.add_argument("--c2t-backend", choices=("python", "numpy"),
+            default="python", help="engine used to convert read sequences")
+    p.add_argument("--decompressor", default="auto",
+            choices=("auto", "python", "thread") + tuple(DECOMPRESSORS),
+            help="how gzipped fastqs are decompressed. by default, bgzip,"
+            " igzip or pigz are used when found, otherwise a python thread."
+            " 'python' decompresses in the converting process")
+    p.add_argument("--compact-tag", action="store_true", help="send a"
+            " bitmask of the converted bases through bwa instead of a copy"
+            " of each read. the original reads are rebuilt from it, so the"
+            " output is the same, but less data goes through bwa")
+    p.add_argument("--c2t-in-process", action="store_true", help="convert"
+            " reads in a process forked from this one and feed bwa through"
+            " a pipe instead of starting a shell pipeline with a second"
+            " python interpreter")
+    p.add_argument("--pipe-buffer", type=int, help="with --c2t-in-process,"
+            " size in bytes of the kernel buffers of the pipes to and from"
+            " bwa (linux only)")
+    p.add_argument("--c2t-cache", help="directory in which to keep converted"
+            " reads so re-aligning the same fastqs (e.g. to a new reference or"
+            " with other bwa options) skips decompression and conversion")
+    p.add_argument("--c2t-cache-size", default="100G", help="size limit of"
+            " --c2t-cache. least recently used entries are removed first")
+    add_trim_args(p)
+    p.add_argument("--c2t-stats", help="write read-length histograms, base"
+            " composition by position and C/T, G/A ratios of the reads to"
+            " this json file as they are converted")
+    add_shard_args(p)
     p.add_argument('-p', '--interleaved', action='store_true', help='fastq files have 4 lines of read1 followed by 4 lines of read2 (e.g. seqtk mergepe output)')
     p.add_argument('--version', action='version', version='bwa-meth.py {}'.format(__version__))
 
@@ -548,16 +3609,48 @@ def main(args=sys.argv[1:]):
             " it as failed QC and un-pair it, and set all members of pair to unmapped")
 
     args, pass_through_args = p.parse_known_args(args)
+    if args.output_format is None:
+        args.output_format = "bam" if args.sort else "sam"
+    if args.sort and args.output_format == "sam":
+        p.error("--sort writes bam, ubam or cram")
 
     # for the 2nd file. use G => A and bwa's support for streaming.
-    conv_fqs_cmd = convert_fqs(args.fastqs)
+    c2t_args = ["--threads", str(args.c2t_threads),
+                "--backend", args.c2t_backend,
+                "--decompressor", args.decompressor]
+    if args.compact_tag:
+        c2t_args.append("--compact-tag")
+    if args.c2t_cache:
+        c2t_args += ["--cache-dir", args.c2t_cache,
+                     "--cache-size", args.c2t_cache_size]
+    if args.c2t_stats:
+        c2t_args += ["--stats", args.c2t_stats]
+    if args.shard:
+        c2t_args += ["--shard", "%d/%d" % (args.shard[0] + 1, args.shard[1]),
+                     "--shard-by", args.shard_by]
+    for name in TRIM_ARGS:
+        value = getattr(args, name.replace("-", "_"))
+        # compare with the default so that e.g. --min-length 0 is passed.
+        if value != p.get_default(name.replace("-", "_")):
+            c2t_args += ["--" + name, str(value)]
+    if args.c2t_in_process:
+        conv_fqs_cmd = c2t_args + c2t_inputs(args.fastqs)
+    else:
+        conv_fqs_cmd = convert_fqs(args.fastqs, c2t_args)
 
     bwa_mem(args.reference, conv_fqs_cmd, ' '.join(map(str, pass_through_args)),
             threads=args.threads,
             rg=args.read_group or rname(*args.fastqs),
             paired=(len(args.fastqs) == 2 or args.interleaved),
             set_as_failed=args.set_as_failed,
-            do_not_penalize_chimeras=args.do_not_penalize_chimeras)
+            do_not_penalize_chimeras=args.do_not_penalize_chimeras,
+            pipe_size=args.pipe_buffer, aligner=args.aligner,
+            post_workers=args.post_workers, out_format=args.output_format,
+            level=args.compression_level, out_threads=args.output_threads,
+            path=args.output, sort=args.sort,
+            memory=parse_size(args.sort_memory), tmp_dir=args.tmp_dir,
+            seqs_per_slice=args.cram_seqs_per_slice,
+            slices_per_container=args.cram_slices_per_container)
     
 
 if __name__ == "__main__":
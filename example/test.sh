@@ -64,6 +64,276 @@ assert " -e bwa-meth-stdin.bam " $LINENO
 diff=`diff <(samtools view bwa-meth.bam) <(samtools view bwa-meth-stdin.bam)`
 assert " $diff == ''" $LINENO
 
+##########################
+# test native bam output
+##########################
+python ../bwameth.py --output-format bam --reference ref.fa t_R1.fastq.gz t_R2.fastq.gz \
+	> bwa-meth-native.bam
+diff=`diff <(samtools view bwa-meth.bam) <(samtools view bwa-meth-native.bam)`
+assert " $diff == ''" $LINENO
+
+##########################
+# test sorted output
+##########################
+rm -f bwa-meth-sorted.bam* bwa-meth-resorted.bam*
+python ../bwameth.py --sort coordinate --output bwa-meth-sorted.bam \
+	--reference ref.fa t_R1.fastq.gz t_R2.fastq.gz
+assert " -e bwa-meth-sorted.bam.bai " $LINENO
+n=`samtools view -H bwa-meth-sorted.bam | grep "^@HD" | grep -c "SO:coordinate"`
+assert "$n -eq 1" $LINENO
+# samtools must accept it as sorted and agree with the index written by bwameth
+cp bwa-meth-sorted.bam bwa-meth-resorted.bam
+samtools index bwa-meth-resorted.bam
+diff=`diff <(samtools idxstats bwa-meth-sorted.bam) <(samtools idxstats bwa-meth-resorted.bam)`
+assert " $diff == ''" $LINENO
+region=`samtools idxstats bwa-meth-sorted.bam | awk '$3 > 0 { print $1; exit }'`
+a=`samtools view -c bwa-meth-sorted.bam $region`
+b=`samtools view -c bwa-meth-resorted.bam $region`
+assert "$a -eq $b" $LINENO
+# same records as the unsorted output
+diff=`diff <(samtools view bwa-meth.bam | sort) <(samtools view bwa-meth-sorted.bam | sort)`
+assert " $diff == ''" $LINENO
+
+##########################
+# test compact tag
+##########################
+python ../bwameth.py --compact-tag --reference ref.fa t_R1.fastq.gz t_R2.fastq.gz \
+	| samtools view -b - > bwa-meth-compact.bam
+diff=`diff <(samtools view bwa-meth.bam) <(samtools view bwa-meth-compact.bam)`
+assert " $diff == ''" $LINENO
+
+##########################
+# test shard and gather
+##########################
+# bwa estimates the insert size per batch of reads, so fix it with -I to get
+# the same alignments from the shards as from a single run.
+rm -f bwa-meth-shard*.bam bwa-meth-gathered.bam*
+python ../bwameth.py -I250,50 --reference ref.fa t_R1.fastq.gz t_R2.fastq.gz \
+	| samtools view -b - > bwa-meth-unsharded.bam
+for i in 1 2 3; do
+	python ../bwameth.py -I250,50 --shard $i/3 --reference ref.fa t_R1.fastq.gz t_R2.fastq.gz \
+		| samtools view -b - > bwa-meth-shard$i.bam
+done
+python ../bwameth.py gather -o bwa-meth-gathered.bam bwa-meth-shard1.bam bwa-meth-shard2.bam bwa-meth-shard3.bam
+assert " -e bwa-meth-gathered.bam " $LINENO
+diff=`diff <(samtools view bwa-meth-unsharded.bam | sort) <(samtools view bwa-meth-gathered.bam | sort)`
+assert " $diff == ''" $LINENO
+
+##########################
+# test in-process conversion
+##########################
+python ../bwameth.py --c2t-in-process --reference ref.fa t_R1.fastq.gz t_R2.fastq.gz \
+	| samtools view -b - > bwa-meth-inproc.bam
+diff=`diff <(samtools view bwa-meth.bam) <(samtools view bwa-meth-inproc.bam)`
+assert " $diff == ''" $LINENO
+# a reader that goes away early must not leave it waiting on bwa forever
+set +e
+timeout 120 python ../bwameth.py --c2t-in-process --reference ref.fa t_R1.fastq.gz t_R2.fastq.gz \
+	2> /dev/null | head -1 > /dev/null
+rc=${PIPESTATUS[0]}
+set -e
+assert "$rc -ne 124" $LINENO
+
+##########################
+# test compact tag with secondary and hard-clipped alignments
+##########################
+# -a makes bwa write secondary alignments, which have no SEQ
+python ../bwameth.py -a --reference ref.fa t_R1.fastq.gz t_R2.fastq.gz \
+	| samtools view -b - > bwa-meth-all.bam
+python ../bwameth.py -a --compact-tag --reference ref.fa t_R1.fastq.gz t_R2.fastq.gz \
+	| samtools view -b - > bwa-meth-all-compact.bam
+n=`samtools view -c -f 0x100 bwa-meth-all.bam`
+assert "$n -gt 0" $LINENO
+diff=`diff <(samtools view bwa-meth-all.bam | awk '$2 >= 256 || $6 ~ /H/') \
+	<(samtools view bwa-meth-all-compact.bam | awk '$2 >= 256 || $6 ~ /H/')`
+assert " $diff == ''" $LINENO
+
+##########################
+# test CRLF fastqs
+##########################
+zcat t_R1.fastq.gz | sed 's/$/\r/' > t_R1.crlf.fastq
+zcat t_R2.fastq.gz | sed 's/$/\r/' > t_R2.crlf.fastq
+n=`diff <(python ../bwameth.py c2t t_R1.fastq.gz t_R2.fastq.gz) \
+	<(python ../bwameth.py c2t t_R1.crlf.fastq t_R2.crlf.fastq) | wc -l`
+assert "$n -eq 0" $LINENO
+rm t_R1.crlf.fastq t_R2.crlf.fastq
+
+##########################
+# test read cache
+##########################
+rm -rf read-cache
+for i in 1 2; do
+	python ../bwameth.py --c2t-cache read-cache --reference ref.fa t_R1.fastq.gz t_R2.fastq.gz \
+		| samtools view -b - > bwa-meth-cached.bam
+	n=`diff <(samtools view bwa-meth.bam) <(samtools view bwa-meth-cached.bam) | wc -l`
+	assert "$n -eq 0" $LINENO
+done
+n=`ls read-cache/*.fq.gz | wc -l`
+assert "$n -eq 1" $LINENO
+rm -rf read-cache
+
+##########################
+# test trimming
+##########################
+# clipping 5 bases from each read removes 5 bases per read and nothing else
+a=`python ../bwameth.py c2t t_R1.fastq.gz t_R2.fastq.gz | awk 'NR % 4 == 2 { n += length($0) } END { print n }'`
+b=`python ../bwameth.py c2t --clip-r1 5 --clip-r2 5 --min-length 0 t_R1.fastq.gz t_R2.fastq.gz \
+	| awk 'NR % 4 == 2 { n += length($0); r++ } END { print n + 5 * r }'`
+assert "$a -eq $b" $LINENO
+n=`python ../bwameth.py --trim-quality 20 --adapter AGATCGGAAGAGC --reference ref.fa \
+	t_R1.fastq.gz t_R2.fastq.gz | samtools view -c -F 4 -`
+assert "$n -gt 0" $LINENO
+
+##########################
+# test read stats
+##########################
+rm -f bwa-meth-stats.json
+python ../bwameth.py --c2t-stats bwa-meth-stats.json --reference ref.fa t_R1.fastq.gz t_R2.fastq.gz \
+	| samtools view -b - > bwa-meth-stats.bam
+reads=`zcat t_R1.fastq.gz | awk 'END { print NR / 4 }'`
+n=`python -c "import json; d = json.load(open('bwa-meth-stats.json')); print(sum(d['r1']['length_histogram'].values()))"`
+assert "$n -eq $reads" $LINENO
+n=`python -c "import json; d = json.load(open('bwa-meth-stats.json')); print(sum(d['r2']['length_histogram'].values()))"`
+assert "$n -eq $reads" $LINENO
+
+##########################
+# test contig filter
+##########################
+rm -rf ref-decoy && mkdir ref-decoy
+(cat ref.fa; echo ">chrREF_decoy"; sed -n 2,20p ref.fa) > ref-decoy/ref.fa
+python ../bwameth.py index --exclude '_decoy$' ref-decoy/ref.fa
+n=`grep -c "^>" ref-decoy/ref.fa.bwameth.c2t`
+assert "$n -eq 2" $LINENO
+n=`grep -c "_decoy" ref-decoy/ref.fa.bwameth.c2t || true`
+assert "$n -eq 0" $LINENO
+n=`python ../bwameth.py --reference ref-decoy/ref.fa t_R1.fastq.gz t_R2.fastq.gz | samtools view -H - | grep -c "^@SQ"`
+assert "$n -eq 1" $LINENO
+
+##########################
+# test incremental reference conversion
+##########################
+python ../bwameth.py index ref-decoy/ref.fa
+# change only the decoy; its conversion is spliced into the existing output
+echo "ACGTACGT" >> ref-decoy/ref.fa
+python ../bwameth.py index ref-decoy/ref.fa 2> ref-decoy/index.log
+n=`grep -c "reused 1" ref-decoy/index.log`
+assert "$n -eq 1" $LINENO
+rm -rf ref-fresh && mkdir ref-fresh && cp ref-decoy/ref.fa ref-fresh/
+python ../bwameth.py index ref-fresh/ref.fa
+cmp ref-decoy/ref.fa.bwameth.c2t ref-fresh/ref.fa.bwameth.c2t
+rm -rf ref-decoy ref-fresh
+
+##########################
+# test shared memory index
+##########################
+python ../bwameth.py shm load --reference ref.fa
+n=`python ../bwameth.py shm list | grep -c "	$PWD/ref.fa$"`
+assert "$n -eq 1" $LINENO
+python ../bwameth.py --reference ref.fa t_R1.fastq.gz t_R2.fastq.gz 2> bwa-meth-shm.log \
+	| samtools view -b - > bwa-meth-shm.bam
+n=`grep -c "shared memory" bwa-meth-shm.log`
+assert "$n -eq 1" $LINENO
+n=`diff <(samtools view bwa-meth.bam) <(samtools view bwa-meth-shm.bam) | wc -l`
+assert "$n -eq 0" $LINENO
+python ../bwameth.py shm drop --reference ref.fa
+n=`python ../bwameth.py shm list | grep -c "	$PWD/ref.fa$" || true`
+assert "$n -eq 0" $LINENO
+
+##########################
+# test index bundles
+##########################
+rm -rf ref-unpacked bwa-meth-ref.pack && mkdir ref-unpacked
+python ../bwameth.py index-pack -o bwa-meth-ref.pack ref.fa
+cp ref.fa ref-unpacked/
+python ../bwameth.py index-unpack -d ref-unpacked bwa-meth-ref.pack
+for ext in "" .amb .ann .bwt .pac .sa; do
+	cmp ref.fa.bwameth.c2t$ext ref-unpacked/ref.fa.bwameth.c2t$ext
+done
+# the unpacked index is current, so it is used as it is
+n=`python ../bwameth.py index ref-unpacked/ref.fa 2>&1 | grep -c "already indexed"`
+assert "$n -eq 1" $LINENO
+rm -rf ref-unpacked bwa-meth-ref.pack
+
+##########################
+# test post-processing workers
+##########################
+python ../bwameth.py --post-workers 3 --reference ref.fa t_R1.fastq.gz t_R2.fastq.gz \
+	| samtools view -b - > bwa-meth-workers.bam
+n=`diff <(samtools view bwa-meth.bam) <(samtools view bwa-meth-workers.bam) | wc -l`
+assert "$n -eq 0" $LINENO
+
+##########################
+# test cram output
+##########################
+rm -f bwa-meth.cram*
+python ../bwameth.py --output-format cram --output bwa-meth.cram --reference ref.fa \
+	t_R1.fastq.gz t_R2.fastq.gz
+n=`diff <(samtools view bwa-meth.bam) <(samtools view -T ref.fa bwa-meth.cram) | wc -l`
+assert "$n -eq 0" $LINENO
+rm -f bwa-meth-sorted.cram*
+python ../bwameth.py --output-format cram --sort coordinate --output bwa-meth-sorted.cram \
+	--reference ref.fa t_R1.fastq.gz t_R2.fastq.gz
+assert " -e bwa-meth-sorted.cram.crai " $LINENO
+
+##########################
+# test c2t with several processes
+##########################
+n=`diff <(python ../bwameth.py c2t t_R1.fastq.gz t_R2.fastq.gz) \
+	<(python ../bwameth.py c2t --threads 3 t_R1.fastq.gz t_R2.fastq.gz) | wc -l`
+assert "$n -eq 0" $LINENO
+
+##########################
+# test numpy c2t backend
+##########################
+if python -c "import numpy" 2> /dev/null; then
+	n=`diff <(python ../bwameth.py c2t t_R1.fastq.gz t_R2.fastq.gz) \
+		<(python ../bwameth.py c2t --backend numpy t_R1.fastq.gz t_R2.fastq.gz) | wc -l`
+	assert "$n -eq 0" $LINENO
+fi
+
+##########################
+# test decompressors
+##########################
+for d in thread auto; do
+	n=`diff <(python ../bwameth.py c2t --decompressor python t_R1.fastq.gz t_R2.fastq.gz) \
+		<(python ../bwameth.py c2t --decompressor $d t_R1.fastq.gz t_R2.fastq.gz) | wc -l`
+	assert "$n -eq 0" $LINENO
+done
+
+##########################
+# test parallel reference conversion
+##########################
+rm -rf ref-parallel && mkdir ref-parallel && cp ref.fa ref-parallel/
+python ../bwameth.py index -t 3 ref-parallel/ref.fa
+cmp ref.fa.bwameth.c2t ref-parallel/ref.fa.bwameth.c2t
+rm -rf ref-parallel
+
+##########################
+# test index manifest
+##########################
+# a newer modification time alone must not cause the index to be rebuilt
+touch ref.fa
+n=`python ../bwameth.py index ref.fa 2>&1 | grep -c "already indexed"`
+assert "$n -eq 1" $LINENO
+
+##########################
+# test bwa-mem2 index detection
+##########################
+if which bwa-mem2 > /dev/null 2>&1; then
+	python ../bwameth.py index-mem2 ref.fa
+	n=`python ../bwameth.py --reference ref.fa t_R1.fastq.gz t_R2.fastq.gz 2> bwa-meth-mem2.log \
+		| samtools view -c -F 4 -`
+	assert "$n -gt 0" $LINENO
+	n=`grep -c "Found BWA MEM2 index" bwa-meth-mem2.log`
+	assert "$n -eq 1" $LINENO
+	n=`python ../bwameth.py --aligner bwa --reference ref.fa t_R1.fastq.gz t_R2.fastq.gz 2> bwa-meth-mem2.log \
+		| samtools view -c -F 4 -`
+	assert "$n -gt 0" $LINENO
+	n=`grep -c "Found BWA MEM index" bwa-meth-mem2.log`
+	assert "$n -eq 1" $LINENO
+	rm ref.fa.bwameth.c2t.0123 ref.fa.bwameth.c2t.bwt.2bit.64
+fi
+
 ##########################
 # test multiple fastq sets
 ##########################